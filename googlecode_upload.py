@@ -56,7 +56,15 @@ import base64
 import sys
 
 
-def upload(file, project_name, user_name, password, summary, labels=None):
+# The file is sent by blocks of this size (constant memory use)
+BLOCK_SIZE = 1024 * 1024
+
+BOUNDARY = '----------Googlecode_boundary_reindeer_flotilla'
+CRLF = '\r\n'
+
+
+def upload(file, project_name, user_name, password, summary, labels=None,
+           progress=None):
   """Upload a file to a Google Code project's file server.
 
   Args:
@@ -67,6 +75,8 @@ def upload(file, project_name, user_name, password, summary, labels=None):
               Note that this is NOT your global Google Account password!
     summary: A small description for the file.
     labels: an optional list of label strings with which to tag the file.
+    progress: an optional callable, called with (bytes sent, total bytes)
+              after each block.
 
   Returns: a tuple:
     http_status: 201 if the upload succeeded, something else if an
@@ -84,21 +94,21 @@ def upload(file, project_name, user_name, password, summary, labels=None):
   if labels is not None:
     form_fields.extend([('label', l.strip()) for l in labels])
 
-  content_type, body = encode_upload_request(form_fields, file)
-
   upload_host = '%s.googlecode.com' % project_name
   upload_uri = '/files'
   auth_token = base64.b64encode('%s:%s'% (user_name, password))
   headers = {
     'Authorization': 'Basic %s' % auth_token,
     'User-Agent': 'Googlecode.com uploader v0.9.4',
-    'Content-Type': content_type,
     }
 
   server = httplib.HTTPSConnection(upload_host)
-  server.request('POST', upload_uri, body, headers)
-  resp = server.getresponse()
-  server.close()
+  try:
+    resp = post_upload_request(server, upload_uri, headers, form_fields, file,
+                               progress)
+    resp.read()
+  finally:
+    server.close()
 
   if resp.status == 201:
     location = resp.getheader('Location', None)
@@ -107,49 +117,106 @@ def upload(file, project_name, user_name, password, summary, labels=None):
   return resp.status, resp.reason, location
 
 
-def encode_upload_request(fields, file_path):
-  """Encode the given fields and file into a multipart form body.
+def encode_upload_stream(fields, file_path, block_size=BLOCK_SIZE):
+  """Encode the given fields and file into a streamed multipart form body.
 
   fields is a sequence of (name, value) pairs. file is the path of
   the file to upload. The file will be uploaded to Google Code with
   the same file name.
 
-  Returns: (content_type, body) ready for httplib.HTTP instance
+  Returns: (content_type, content_length, chunks) where chunks is a
+  generator of body strings: the fields and file headers, the file
+  contents read by blocks of block_size bytes, then the final boundary.
   """
-  BOUNDARY = '----------Googlecode_boundary_reindeer_flotilla'
-  CRLF = '\r\n'
-
-  body = []
+  head = []
 
   # Add the metadata about the upload first
   for key, value in fields:
-    body.extend(
+    head.extend(
       ['--' + BOUNDARY,
        'Content-Disposition: form-data; name="%s"' % key,
        '',
        value,
        ])
 
-  # Now add the file itself
+  # Now add the file headers, the file itself is streamed
   file_name = os.path.basename(file_path)
-  f = open(file_path, 'rb')
-  file_content = f.read()
-  f.close()
-
-  body.extend(
+  head.extend(
     ['--' + BOUNDARY,
      'Content-Disposition: form-data; name="filename"; filename="%s"'
      % file_name,
      # The upload server determines the mime-type, no need to set it.
      'Content-Type: application/octet-stream',
      '',
-     file_content,
+     '',
      ])
+  head = CRLF.join(head)
 
   # Finalize the form body
-  body.extend(['--' + BOUNDARY + '--', ''])
+  tail = CRLF.join(['', '--' + BOUNDARY + '--', ''])
+
+  content_length = len(head) + os.path.getsize(file_path) + len(tail)
+
+  def chunks():
+    yield head
+    f = open(file_path, 'rb')
+    try:
+      while True:
+        block = f.read(block_size)
+        if not block:
+          break
+        yield block
+    finally:
+      f.close()
+    yield tail
+
+  return ('multipart/form-data; boundary=%s' % BOUNDARY, content_length,
+          chunks())
 
-  return 'multipart/form-data; boundary=%s' % BOUNDARY, CRLF.join(body)
+
+def encode_upload_request(fields, file_path):
+  """Encode the given fields and file into a multipart form body.
+
+  Returns: (content_type, body) ready for httplib.HTTP instance
+
+  Note that the whole body is held in memory: see encode_upload_stream.
+  """
+  content_type, _content_length, chunks = encode_upload_stream(fields,
+                                                               file_path)
+  return content_type, ''.join(chunks)
+
+
+def post_upload_request(connection, uri, headers, fields, file_path,
+                        progress=None, block_size=BLOCK_SIZE):
+  """POST the given fields and file to uri as a streamed multipart form.
+
+  Args:
+    connection: Any httplib connection (e.g. an HTTPConnection to a local
+                test server).
+    uri: The upload URI on this connection.
+    headers: Additional request headers (Authorization, User-Agent...).
+    fields, file_path: See encode_upload_stream.
+    progress: an optional callable, called with (bytes sent, total bytes)
+              after each block.
+    block_size: Size of file blocks read and sent.
+
+  Returns: the httplib response.
+  """
+  content_type, content_length, chunks = encode_upload_stream(
+    fields, file_path, block_size)
+  connection.putrequest('POST', uri)
+  for key, value in headers.items():
+    connection.putheader(key, value)
+  connection.putheader('Content-Type', content_type)
+  connection.putheader('Content-Length', str(content_length))
+  connection.endheaders()
+  sent = 0
+  for chunk in chunks:
+    connection.send(chunk)
+    sent += len(chunk)
+    if progress is not None:
+      progress(sent, content_length)
+  return connection.getresponse()
 
 
 def upload_find_auth(file_path, project_name, summary, labels=None,
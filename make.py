@@ -14,10 +14,19 @@ from __future__ import print_function
 
 import os
 import os.path as osp
+import io
+import hashlib
+import json
 import re
 import subprocess
 import shutil
 import sys
+import time
+import threading
+import traceback
+import multiprocessing
+import cProfile
+from contextlib import contextmanager
 
 # Local imports
 from winpython import disthelpers as dh
@@ -28,6 +37,10 @@ import diff
 CHANGELOGS_DIR = osp.join(osp.dirname(__file__), 'changelogs')
 assert osp.isdir(CHANGELOGS_DIR)
 
+# Lock protecting files shared by builds (package indexes and changelogs):
+# replaced by a process lock in make_matrix worker processes
+OUTPUT_LOCK = threading.Lock()
+
 
 def get_drives():
     """Return all active drives"""
@@ -36,7 +49,11 @@ def get_drives():
 
 
 def get_nsis_exe():
-    """Return NSIS executable"""
+    """Return NSIS executable: the WINPYTHON_MAKENSIS environment variable, if
+    set, overrides it (e.g. with a stub compiler when testing builds)"""
+    exe = os.environ.get('WINPYTHON_MAKENSIS')
+    if exe:
+        return exe
     localdir = osp.join(sys.prefix, os.pardir, os.pardir)
     for drive in get_drives():
         for dirname in (r'C:\Program Files', r'C:\Program Files (x86)',
@@ -58,38 +75,344 @@ def get_nsis_exe():
 NSIS_EXE = get_nsis_exe()
 
 
-def replace_in_nsis_file(fname, data):
-    """Replace text in line starting with *start*, from this position:
-    data is a list of (start, text) tuples"""
-    fd = open(fname, 'U')
-    lines = fd.readlines()
-    fd.close()
-    for idx, line in enumerate(lines):
+class NSISTemplate(object):
+    """NSIS script template, parsed once: lines starting with a directive
+    (e.g. '!define COMMAND', 'Icon' or 'OutFile') are indexed so that
+    rendering is a single pass over the template"""
+    _templates = {}  # {fname: (mtime, NSISTemplate)}
+
+    def __init__(self, fname):
+        # latin-1: template bytes are kept as is
+        with io.open(fname, encoding='latin-1') as fd:
+            self.lines = fd.readlines()
+        self.index = {}  # {directive: [line index]}
+        for idx, line in enumerate(self.lines):
+            words = line.split(' ', 2)
+            if words[0] == '!define' and len(words) == 3:
+                key = ' '.join(words[:2])
+            elif len(words) > 1:
+                key = words[0]
+            else:
+                continue
+            self.index.setdefault(key, []).append(idx)
+
+    @classmethod
+    def get(cls, fname):
+        """Return template *fname* (cached until file is modified)"""
+        mtime = os.stat(fname).st_mtime
+        cached = cls._templates.get(fname)
+        if cached is None or cached[0] != mtime:
+            cached = cls._templates[fname] = (mtime, cls(fname))
+        return cached[1]
+
+    def render(self, data):
+        """Return script text, replacing text in line starting with *start*,
+        from this position: data is a list of (start, text) tuples"""
+        lines = list(self.lines)
         for start, text in data:
             if start not in ('Icon', 'OutFile') and not start.startswith('!'):
                 start = '!define ' + start
-            if line.startswith(start + ' '):
-                lines[idx] = line[:len(start)+1] + ('"%s"' % text) + '\n'
-    fd = open(fname, 'w')
-    fd.writelines(lines)
-    fd.close()
+            for idx in self.index.get(start, []):
+                lines[idx] = start + ' ' + ('"%s"' % text) + '\n'
+        return ''.join(lines)
+
+    def write(self, fname, data):
+        """Render script to file *fname*"""
+        with io.open(fname, 'w', encoding='latin-1') as fd:
+            fd.write(self.render(data))
+
+
+def replace_in_nsis_file(fname, data):
+    """Replace text in line starting with *start*, from this position:
+    data is a list of (start, text) tuples"""
+    NSISTemplate(fname).write(fname, data)
 
 
-def build_nsis(srcname, dstname, data):
-    """Build NSIS script"""
+def build_nsis(srcname, dstname, data, workdir=None):
+    """Build NSIS script, return True if successful
+    workdir: directory of the script relative paths (default: directory
+    of the script *dstname*)"""
     portable_dir = osp.join(osp.dirname(osp.abspath(__file__)), 'portable')
-    shutil.copy(osp.join(portable_dir, srcname), dstname)
     data = [('!addincludedir', osp.join(portable_dir, 'include'))
             ] + list(data)
-    replace_in_nsis_file(dstname, data)
+    NSISTemplate.get(osp.join(portable_dir, srcname)).write(dstname, data)
+    options = '' if workdir is None else ' /NOCD'
+    retcode = None
     try:
-        retcode = subprocess.call('"%s" -V2 "%s"' % (NSIS_EXE, dstname),
-                                  shell=True, stdout=sys.stderr)
+        retcode = subprocess.call('"%s" -V2%s "%s"'
+                                  % (NSIS_EXE, options, dstname),
+                                  shell=True, stdout=sys.stderr, cwd=workdir)
         if retcode < 0:
             print("Child was terminated by signal", -retcode, file=sys.stderr)
     except OSError as e:
         print("Execution failed:", e, file=sys.stderr)
     os.remove(dstname)
+    return retcode == 0
+
+
+class BuildManifest(object):
+    """Build manifest: digests of the inputs of each build step (and paths
+    of what it produced), so that an incremental build only redoes the steps
+    whose inputs have changed since the previous build
+
+    Steps are named 'python', 'package:<filename>', 'tools', 'docs' and
+    'launcher:<name>'"""
+    def __init__(self, fname):
+        self.fname = fname
+        self.steps = {}  # {step: {'digest': digest, 'outputs': [path]}}
+        self.hashes = {}  # file digests cache: {path: [size, mtime, digest]}
+        self.hits = []
+        self.misses = []
+        if osp.isfile(fname):
+            try:
+                with open(fname) as fd:
+                    contents = json.load(fd)
+                self.steps = contents['steps']
+                self.hashes = contents['hashes']
+            except (IOError, ValueError, KeyError):
+                print("WARNING: ignoring invalid build manifest %s" % fname,
+                      file=sys.stderr)
+
+    def save(self):
+        """Save manifest"""
+        with open(self.fname, 'w') as fd:
+            json.dump({'steps': self.steps, 'hashes': self.hashes}, fd,
+                      indent=1, sort_keys=True)
+
+    @staticmethod
+    def digest(*items):
+        """Return digest of items (strings, numbers and lists of them)"""
+        return hashlib.sha256(repr(items).encode('utf-8')).hexdigest()
+
+    def file_digest(self, fname):
+        """Return file contents digest (cached on file size and mtime)"""
+        fname = osp.abspath(fname)
+        stat = os.stat(fname)
+        key = [stat.st_size, stat.st_mtime]
+        cached = self.hashes.get(fname)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(fname, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b''):
+                sha.update(chunk)
+        self.hashes[fname] = key + [sha.hexdigest()]
+        return sha.hexdigest()
+
+    def tree_digest(self, dirnames):
+        """Return digest of directory trees (relative paths, sizes and
+        mtimes of all files: tools and docs are too big to be hashed)"""
+        entries = []
+        for dirname in dirnames:
+            entries.append(osp.abspath(dirname))
+            for root, dirs, files in os.walk(dirname):
+                dirs.sort()
+                for name in sorted(files):
+                    path = osp.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((osp.relpath(path, dirname),
+                                    stat.st_size, stat.st_mtime))
+        return self.digest(entries)
+
+    def is_uptodate(self, step, digest, valid=True):
+        """Return True if step was done by previous build with the same
+        inputs and if its outputs still exist (i.e. a cache hit)
+        valid=False: force a cache miss"""
+        previous = self.steps.get(step)
+        hit = valid and previous is not None \
+              and previous['digest'] == digest \
+              and all(osp.exists(path) for path in previous['outputs'])
+        (self.hits if hit else self.misses).append(step)
+        return hit
+
+    def update(self, step, digest, outputs=()):
+        """Record step as done with these inputs, producing outputs"""
+        self.steps[step] = {'digest': digest,
+                            'outputs': [osp.abspath(path) for path in outputs]}
+        self.save()
+
+    def invalidate(self, prefix):
+        """Forget steps starting with prefix"""
+        for step in list(self.steps):
+            if step.startswith(prefix):
+                self.steps.pop(step)
+        self.save()
+
+    def get_stale_steps(self, prefix):
+        """Return steps starting with prefix recorded by a previous build
+        but not checked by this one (e.g. removed packages)"""
+        checked = set(self.hits + self.misses)
+        return sorted(step for step in self.steps
+                      if step.startswith(prefix) and step not in checked)
+
+    def get_report(self):
+        """Return cache hits and misses report, per step kind"""
+        counts = {}
+        for index, steps in enumerate((self.hits, self.misses)):
+            for step in steps:
+                counts.setdefault(step.split(':')[0], [0, 0])[index] += 1
+        lines = ['%s: %d hit(s), %d miss(es)' % (kind, hits, misses)
+                 for kind, (hits, misses) in sorted(counts.items())]
+        lines += ['  rebuilt: %s' % step for step in self.misses
+                  if step.startswith(('launcher:', 'package:'))]
+        return '\n'.join(lines)
+
+
+class BuildProfile(object):
+    """Build profile: phase and package timings, bytes copied, number of
+    subprocesses and peak memory of a build, saved as JSON so that builds
+    may be compared"""
+    def __init__(self):
+        self.t0 = time.time()
+        self.phases = []  # [[name, start, end]]
+        self.packages = []  # [[package file names, seconds]]
+        self.bytes_copied = 0
+        self.subprocesses = 0
+        self._lock = threading.Lock()  # subprocesses may start in threads
+
+    def start_phase(self, name):
+        """Start phase (ending the current one)"""
+        self.stop()
+        self.phases.append([name, time.time(), None])
+
+    def stop(self):
+        """End current phase"""
+        if self.phases and self.phases[-1][2] is None:
+            self.phases[-1][2] = time.time()
+
+    @contextmanager
+    def time_packages(self, fnames):
+        """Time installation of package files"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.packages.append([[osp.basename(fname) for fname in fnames],
+                                  time.time() - t0])
+
+    def add_copied(self, path):
+        """Add size of copied file or directory *path*"""
+        if osp.isdir(path):
+            for root, _dirs, files in os.walk(path):
+                for name in files:
+                    self.bytes_copied += osp.getsize(osp.join(root, name))
+        else:
+            self.bytes_copied += osp.getsize(path)
+
+    @contextmanager
+    def count_subprocesses(self):
+        """Count subprocesses started in this context (subprocess.call,
+        check_output, ... and subprocess.Popen)"""
+        popen = subprocess.Popen
+        profile = self
+
+        class CountingPopen(popen):
+            def __init__(self, *args, **kwargs):
+                with profile._lock:
+                    profile.subprocesses += 1
+                popen.__init__(self, *args, **kwargs)
+        subprocess.Popen = CountingPopen
+        try:
+            yield
+        finally:
+            subprocess.Popen = popen
+
+    @staticmethod
+    def get_peak_memory():
+        """Return peak memory (bytes) of this process and of its terminated
+        subprocesses (None if unknown: psutil is required on Windows and
+        only gives this process peak memory)"""
+        try:
+            import resource
+        except ImportError:
+            try:
+                import psutil
+            except ImportError:
+                return None, None
+            infos = psutil.Process(os.getpid()).memory_info()
+            return getattr(infos, 'peak_wset', infos.rss), None
+        # ru_maxrss is in kilobytes
+        return tuple(resource.getrusage(who).ru_maxrss * 1024 for who in
+                     (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+    def save(self, fname):
+        """Save profile to JSON file *fname*"""
+        self.stop()
+        peak, peak_children = self.get_peak_memory()
+        profile = {
+            'total': time.time() - self.t0,
+            'phases': [{'name': name, 'seconds': end - start}
+                       for name, start, end in self.phases],
+            'packages': [{'packages': fnames, 'seconds': seconds}
+                         for fnames, seconds in self.packages],
+            'bytes_copied': self.bytes_copied,
+            'subprocesses': self.subprocesses,
+            'peak_memory': peak,
+            'peak_memory_subprocesses': peak_children,
+            }
+        with open(fname, 'w') as fd:
+            json.dump(profile, fd, indent=1, sort_keys=True)
+
+
+class WheelDirIndex(object):
+    """Index of the package files of a directory (wheels, installers and
+    source archives), answering file name, regular expression and project
+    name queries without scanning the directory.
+    The index is rebuilt when the directory mtime changes."""
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.fnames = []  # directory listing order (first match wins)
+        self._mtime = None
+        self._fnameset = set()
+        self._patterns = {}  # {pattern: first matching file name or None}
+        self._names = {}  # {normalized name: [(fname, PackageInfos)]}
+        self.refresh()
+
+    def refresh(self):
+        """Rebuild index if directory has changed"""
+        mtime = os.stat(self.dirname).st_mtime
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self.fnames = os.listdir(self.dirname)
+        self._fnameset = set(self.fnames)
+        self._patterns = {}
+        self._names = {}
+        for fname in self.fnames:
+            infos = utils.get_package_infos(fname)
+            if infos is not None:
+                self._names.setdefault(wppm.normalize_name(infos.name),
+                                       []).append((fname, infos))
+
+    def match(self, pattern):
+        """Return the file name equal to pattern or else the first one (in
+        listing order) matching pattern (regular expression), None if there
+        is none"""
+        self.refresh()
+        if pattern in self._fnameset:
+            return pattern
+        try:
+            return self._patterns[pattern]
+        except KeyError:
+            regexp = re.compile(pattern)
+            for fname in self.fnames:
+                if regexp.match(fname) is not None:
+                    break
+            else:
+                fname = None
+            self._patterns[pattern] = fname
+            return fname
+
+    def get_candidates(self, name):
+        """Return the (file name, PackageInfos) list of project name
+        (any version, architecture or Python version), in listing order"""
+        self.refresh()
+        return list(self._names.get(wppm.normalize_name(name), []))
+
+    def get_names(self):
+        """Return normalized project names"""
+        self.refresh()
+        return sorted(self._names)
 
 
 class WinPythonDistribution(object):
@@ -127,6 +450,13 @@ class WinPythonDistribution(object):
         self.rootdir = rootdir  # addded to build from winpython
         self.install_options = install_options
         self.flavor = flavor
+        self.manifest = None  # BuildManifest (incremental build only)
+        self._wheel_index = None
+        self.profile = BuildProfile()
+        self._launcher_jobs = None  # launchers to be compiled
+        self._batch_scripts = None  # batch scripts to be written
+        self._portable_digest = None  # see create_launcher
+        self._msvc_dlls = None  # see _get_msvc_dlls
 
     @property
     def package_index_wiki(self):
@@ -264,16 +594,22 @@ Name | Version | Description
         else:
             return self._docsdirs
 
+    @property
+    def wheel_index(self):
+        """Return wheeldir index (WheelDirIndex)"""
+        if self._wheel_index is None:
+            self._wheel_index = WheelDirIndex(self.wheeldir)
+        else:
+            self._wheel_index.refresh()
+        return self._wheel_index
+
     def get_package_fname(self, pattern):
         """Get package matching pattern in wheeldir"""
-        path = self.wheeldir
-        for fname in os.listdir(path):
-            match = re.match(pattern, fname)
-            if match is not None or pattern == fname:
-                return osp.abspath(osp.join(path, fname))
-        else:
+        fname = self.wheel_index.match(pattern)
+        if fname is None:
             raise RuntimeError(
                 'Could not found required package matching %s' % pattern)
+        return osp.abspath(osp.join(self.wheeldir, fname))
 
     def install_package(self, pattern, install_options=None):
         """Install package matching pattern"""
@@ -283,22 +619,73 @@ Name | Version | Description
             if self.simulation:
                 self.distribution._print(pack, "Installing")
                 self.distribution._print_done()
-            else:
-                if install_options:
-                    self.distribution.install(pack, install_options)
-                else:
-                    self.distribution.install(pack,
-                                         install_options=self.install_options)
+            elif not self._is_package_uptodate(pack):
+                with self.profile.time_packages([fname]):
+                    if install_options:
+                        self.distribution.install(pack, install_options)
+                    else:
+                        self.distribution.install(
+                            pack, install_options=self.install_options)
+                self._update_package_manifest([pack])
             self.installed_packages.append(pack)
 
+    def _is_package_uptodate(self, pack):
+        """Return True if package file was already installed by previous
+        build (incremental build only)"""
+        if self.manifest is None:
+            return False
+        step = 'package:' + osp.basename(pack.fname)
+        valid = step in self.manifest.steps \
+                and self.distribution.find_package(pack.name) is not None
+        return self.manifest.is_uptodate(
+            step, self.manifest.file_digest(pack.fname), valid=valid)
+
+    def _update_package_manifest(self, packages):
+        """Record packages as installed in build manifest"""
+        if self.manifest is not None:
+            for pack in packages:
+                self.manifest.update('package:' + osp.basename(pack.fname),
+                                     self.manifest.file_digest(pack.fname))
+
+    def _remove_stale_packages(self):
+        """Uninstall packages installed by previous build whose file has
+        been removed from wheeldir (incremental build only)"""
+        if self.manifest is None:
+            return
+        names = set(wppm.normalize_name(pack.name)
+                    for pack in self.installed_packages)
+        for step in self.manifest.get_stale_steps('package:'):
+            try:
+                name = wppm.Package(step[len('package:'):]).name
+            except NotImplementedError:
+                name = None
+            if name is not None and wppm.normalize_name(name) not in names:
+                pack = self.distribution.find_package(name)
+                if pack is not None:
+                    self.distribution.uninstall(pack)
+            self.manifest.invalidate(step)
+
     def create_batch_script(self, name, contents):
         """Create batch script %WINPYDIR%/name"""
+        if self._batch_scripts is not None:
+            # written later, together (see write_batch_scripts)
+            self._batch_scripts[name] = contents
+        else:
+            self._batch_scripts = {name: contents}
+            self.write_batch_scripts()
+
+    def write_batch_scripts(self):
+        """Write batch scripts created since _batch_scripts was set to {},
+        only if their contents changed"""
+        scripts, self._batch_scripts = self._batch_scripts, None
         scriptdir = osp.join(self.winpydir, 'scripts')
         if not osp.isdir(scriptdir):
             os.mkdir(scriptdir)
-        fd = open(osp.join(scriptdir, name), 'w')
-        fd.write(contents)
-        fd.close()
+        written = [name for name, contents in sorted(scripts.items())
+                   if utils.write_file_if_changed(osp.join(scriptdir, name),
+                                                  contents)]
+        if self.verbose:
+            print("%d/%d batch scripts written" % (len(written), len(scripts)))
 
     def create_launcher(self, name, icon, command=None,
                         args=None, workdir=None, settingspath=None):
@@ -344,7 +731,33 @@ Name | Version | Description
             data += [('SETTINGSDIR', osp.dirname(settingspath)),
                      ('SETTINGSNAME', osp.basename(settingspath))]
 
-        build_nsis('launcher.nsi', fname, data)
+        digest = None
+        if self.manifest is not None:
+            if self._portable_digest is None:
+                # NSIS sources, icons: walked once per build
+                self._portable_digest = self.manifest.tree_digest(
+                    [portable_dir])
+            digest = self.manifest.digest(data, self._portable_digest)
+            if self.manifest.is_uptodate('launcher:' + name, digest):
+                return
+        job = (name, fname, data, digest)
+        if self._launcher_jobs is not None:
+            # compiled later, in parallel (see _create_launchers)
+            self._launcher_jobs.append(job)
+        else:
+            self._build_launchers([job])
+
+    def _build_launchers(self, jobs):
+        """Compile launchers NSIS scripts in parallel: jobs is a list of
+        (name, nsi file name, data, build manifest digest) tuples"""
+        if not jobs:
+            return
+        build = lambda job: build_nsis('launcher.nsi', job[1], job[2])
+        results = utils.parallel_map(build, jobs, multiprocessing.cpu_count())
+        for (name, _fname, _data, digest), success in zip(jobs, results):
+            if success and digest is not None:
+                self.manifest.update('launcher:' + name, digest,
+                                     [osp.join(self.winpydir, name)])
 
     def create_python_batch(self, name, script_name,
                             workdir=None, options=None):
@@ -371,14 +784,21 @@ call %~dp0env.bat
     def create_installer(self):
         """Create installer with NSIS"""
         self._print("Creating WinPython installer")
-        portable_dir = osp.join(osp.dirname(osp.abspath(__file__)), 'portable')
-        fname = osp.join(portable_dir, 'installer-tmp.nsi')
+        self.profile.start_phase('installer')
+        # (one script per build: builds may run in parallel, see make_matrix;
+        # not in portable directory, which is an input of launchers)
+        fname = osp.join(self.target, 'installer-tmp%s-%s.nsi'
+                         % (self.flavor, osp.basename(self.winpydir)))
         data = (('DISTDIR', self.winpydir),
                 ('ARCH', self.winpy_arch),
                 ('VERSION', '%s.%d%s' % (self.python_fullversion,
                                        self.build_number, self.flavor)),
                 ('RELEASELEVEL', self.release_level),)
-        build_nsis('installer.nsi', fname, data)
+        with self.profile.count_subprocesses():
+            # images, icons: relative to portable directory
+            build_nsis('installer.nsi', fname, data, workdir=osp.join(
+                osp.dirname(osp.abspath(__file__)), 'portable'))
+        self._save_profile()
         self._print_done()
 
     def _print(self, text):
@@ -403,41 +823,53 @@ call %~dp0env.bat
             os.mkdir(osp.join(self.python_dir, 'Scripts'))
         self._print_done()
 
+    def _get_msvc_dlls(self):
+        """Return Microsoft Visual C++ DLLs to be added to Python directory"""
+        if self._msvc_dlls is None:
+            msvc_version = dh.get_msvc_version(self.python_version)
+            architecture = 64 if self.python_name.endswith('.amd64') else 32
+            self._msvc_dlls = dh.get_msvc_dlls(msvc_version,
+                                               architecture=architecture)
+        return self._msvc_dlls
+
+    def _get_python_digest(self):
+        """Return digest of Python setup inputs: Python installer, Microsoft
+        Visual C++ DLLs and run_required_first.bat scripts"""
+        fnames = [self.python_fname] + list(self._get_msvc_dlls()) + \
+            self._get_complement_batch_scripts("run_required_first.bat")
+        return self.manifest.digest([(osp.basename(fname),
+                                      self.manifest.file_digest(fname))
+                                     for fname in fnames])
+
     def _add_msvc_files(self):
         """Adding Microsoft Visual C++ DLLs"""
         print("Adding Microsoft Visual C++ DLLs""")
-        msvc_version = dh.get_msvc_version(self.distribution.version)
-        for fname in dh.get_msvc_dlls(msvc_version,
-                                  architecture=self.distribution.architecture):
+        for fname in self._get_msvc_dlls():
             shutil.copy(fname, self.python_dir)
+            self.profile.add_copied(fname)
 
     def _check_packages(self):
-        """Check packages for duplicates or unsupported packages"""
+        """Check packages for duplicates, unsupported packages, architecture
+        and Python version mismatches: return the list of utils.PackageIssue"""
         print("Checking packages")
-        packages = []
-        my_plist = []
-        my_plist += os.listdir(self.wheeldir)
-        for fname0 in my_plist:
-            fname = self.get_package_fname(fname0)
-            if fname == self.python_fname:
-                continue
-            try:
-                pack = wppm.Package(fname)
-            except NotImplementedError:
+        fnames = [fname for fname in self.wheel_index.fnames
+                  if fname != osp.basename(self.python_fname)]
+        issues = utils.check_package_files(
+            fnames, architecture=self.distribution.architecture,
+            pyversion=self.python_version)
+        for issue in issues:
+            if issue.kind == 'unsupported':
                 print("WARNING: package %s is not supported"
-                      % osp.basename(fname), file=sys.stderr)
-                continue
-            packages.append(pack)
-        all_duplicates = []
-        for pack in packages:
-            if pack.name in all_duplicates:
-                continue
-            all_duplicates.append(pack.name)
-            duplicates = [p for p in packages if p.name == pack.name]
-            if len(duplicates) > 1:
-                print("WARNING: duplicate packages %s (%s)" %
-                      (pack.name, ", ".join([p.version for p in duplicates])),
+                      % issue.fnames[0], file=sys.stderr)
+            elif issue.kind == 'duplicate':
+                print("WARNING: duplicate packages %s (%s)"
+                      % (issue.name, ", ".join(issue.fnames)),
                       file=sys.stderr)
+            else:
+                print("WARNING: %s mismatch for %s (%s)"
+                      % (issue.kind, issue.name, ", ".join(issue.fnames)),
+                      file=sys.stderr)
+        return issues
 
     def _install_required_packages(self):
         """Installing required packages"""
@@ -462,52 +894,125 @@ call %~dp0env.bat
             self.install_package(
                 '%s-([0-9\.]*[a-z\+]*[0-9]?)(.*)(\.exe|\.whl)' % happy_few)
 
+    def install_wheels(self, packages, install_options=None):
+        """Install wheel packages with a single pip session, falling back to
+        one by one installation if it fails"""
+        if install_options is None:
+            install_options = self.install_options
+        if self.simulation:
+            for pack in packages:
+                self.distribution._print(pack, "Installing")
+                self.distribution._print_done()
+        elif packages:
+            try:
+                with self.profile.time_packages([pack.fname
+                                                 for pack in packages]):
+                    self.distribution.install_wheels(packages,
+                                                     install_options)
+            except RuntimeError:
+                print("WARNING: batch install failed, installing wheels "
+                      "one by one", file=sys.stderr)
+                for pack in packages:
+                    with self.profile.time_packages([pack.fname]):
+                        self.distribution.install(pack, install_options)
+            self._update_package_manifest(packages)
+        self.installed_packages.extend(packages)
+
     def _install_all_other_packages(self):
         """Try to install all other packages in wheeldir"""
         print("Installing other packages")
-        my_list = []
-        my_list += os.listdir(self.wheeldir)
-        for fname in my_list:
-            if osp.basename(fname) != osp.basename(self.python_fname):
-                try:
-                    self.install_package(fname)
-                except NotImplementedError:
-                    print("WARNING: unable to install package %s"
-                          % osp.basename(fname), file=sys.stderr)
+        index = self.wheel_index
+        python_fname = osp.basename(self.python_fname)
+        for fname in index.fnames:
+            if fname == python_fname or (
+                    fname.endswith('.whl') and
+                    utils.get_package_infos(fname) is not None):
+                # supported wheels are installed together, after this loop
+                continue
+            try:
+                self.install_package(fname)
+            except NotImplementedError:
+                print("WARNING: unable to install package %s"
+                      % osp.basename(fname), file=sys.stderr)
+        # pip refuses several versions of a project in one session: the first
+        # wheel of a project goes in the batch, the other ones are installed
+        # after it, as before (last one wins)
+        installed = set(p.fname for p in self.installed_packages)
+        batch, others = [], []
+        for name in index.get_names():
+            wheels = [wppm.Package(self.get_package_fname(fname))
+                      for fname, _infos in index.get_candidates(name)
+                      if fname.endswith('.whl') and fname != python_fname]
+            wheels = [pack for pack in wheels if pack.fname not in installed]
+            batch += wheels[:1]
+            others += wheels[1:]
+        if batch:
+            if not self.simulation:
+                uptodate = [pack for pack in batch
+                            if self._is_package_uptodate(pack)]
+                self.installed_packages.extend(uptodate)
+                batch = [pack for pack in batch if pack not in uptodate]
+            self.install_wheels(batch)
+        for pack in others:
+            self.install_package(pack.fname)
+
+    def _copy_trees(self, source_dirs, targetdir):
+        """Copy source_dirs entries into targetdir (see utils.copy_trees)"""
+        stats = utils.copy_trees(source_dirs, targetdir,
+                                 processes=4*multiprocessing.cpu_count(),
+                                 verbose=self.verbose)
+        self.profile.bytes_copied += stats['bytes']
+        if self.verbose:
+            print(utils.get_copy_report(stats))
+        return stats
 
     def _copy_dev_tools(self):
         """Copy dev tools"""
-        self._print("Copying tools")
         toolsdir = osp.join(self.winpydir, 'tools')
-        os.mkdir(toolsdir)
-        for dirname in self.toolsdirs:
-            for name in os.listdir(dirname):
-                path = osp.join(dirname, name)
-                copy = shutil.copytree if osp.isdir(path) else shutil.copyfile
-                copy(path, osp.join(toolsdir, name))
-                if self.verbose:
-                    print(path + ' --> ' + osp.join(toolsdir, name))
+        digest = None
+        if self.manifest is not None:
+            digest = self.manifest.tree_digest(self.toolsdirs)
+            if self.manifest.is_uptodate('tools', digest):
+                return
+        self._print("Copying tools")
+        self._copy_trees(self.toolsdirs, toolsdir)
+        if digest is not None:
+            self.manifest.update('tools', digest, [toolsdir])
         self._print_done()
 
     def _copy_dev_docs(self):
         """Copy dev docs"""
-        self._print("Copying Noteebook docs")
-        docsdir = osp.join(self.winpydir, 'notebooks')
-        os.mkdir(docsdir)
         docsdir = osp.join(self.winpydir, 'notebooks', 'docs')
-        os.mkdir(docsdir)
-        for dirname in self.docsdirs:
-            for name in os.listdir(dirname):
-                path = osp.join(dirname, name)
-                copy = shutil.copytree if osp.isdir(path) else shutil.copyfile
-                copy(path, osp.join(docsdir, name))
-                if self.verbose:
-                    print(path + ' --> ' + osp.join(docsdir, name))
+        digest = None
+        if self.manifest is not None:
+            digest = self.manifest.tree_digest(self.docsdirs)
+            if self.manifest.is_uptodate('docs', digest):
+                return
+        self._print("Copying Noteebook docs")
+        if not osp.isdir(osp.dirname(docsdir)):
+            # launchers working directory
+            os.mkdir(osp.dirname(docsdir))
+        self._copy_trees(self.docsdirs, docsdir)
+        if digest is not None:
+            self.manifest.update('docs', digest, [docsdir])
         self._print_done()
 
     def _create_launchers(self):
-        """Create launchers"""
+        """Create launchers: NSIS compilations run in parallel, each launcher
+        having its own NSIS script"""
         self._print("Creating launchers")
+        self._portable_digest = None
+        self._launcher_jobs = []
+        try:
+            self._add_launchers()
+            jobs = self._launcher_jobs
+        finally:
+            self._launcher_jobs = None
+        self._build_launchers(jobs)
+        self._print_done()
+
+    def _add_launchers(self):
+        """Add launchers (see create_launcher)"""
         self.create_launcher('WinPython Command Prompt.exe', 'cmd.ico',
                              command='$SYSDIR\cmd.exe',
                              args='/k', workdir='${WINPYDIR}')
@@ -608,8 +1113,6 @@ call %~dp0env.bat
                                  command='${WINPYDIR}\..'+ julia_exe,
                                  workdir=r'${WINPYDIR}\..\notebooks')
 
-        self._print_done()
-
     def _create_batch_scripts_initial(self):
         """Create batch scripts"""
         self._print("Creating batch scripts initial")
@@ -642,6 +1145,7 @@ set PATH=""" + path)
     def _create_batch_scripts(self):
         """Create batch scripts"""
         self._print("Creating batch scripts")
+        self._batch_scripts = {}
         self.create_batch_script('readme.txt',
 r"""These batch files are not required to run WinPython.
 
@@ -956,6 +1460,8 @@ call %~dp0register_python.bat --all""")
         self.create_python_batch('pyqt5_demo.bat', 'qtdemo.pyw',
              workdir=r'Lib\site-packages\PyQt5\examples\qtdemo')
 
+        self.write_batch_scripts()
+
         # pre-run mingw batch
         print('now pre-running extra mingw')
         filepath = osp.join(self.winpydir, 'scripts', 'make_cython_use_mingw.bat')
@@ -964,30 +1470,61 @@ call %~dp0register_python.bat --all""")
 
         self._print_done()
 
+    def _get_complement_batch_scripts(self, this_batch):
+        """Return tools\..\<this_batch> scripts"""
+        return [filepath for filepath in
+                sorted(set(osp.join(osp.dirname(s), this_batch)
+                           for s in self._toolsdirs))
+                if osp.isfile(filepath)]
+
     def _run_complement_batch_scripts(self, this_batch="run_complement.bat"):
         """ tools\..\run_complement.bat for final complements"""
         print('now %s in tooldirs\..' % this_batch)
-        for post_complement in list(set([osp.dirname(s)
-                                         for s in self._toolsdirs])):
-            filepath = osp.join(post_complement, this_batch)
-            if osp.isfile(filepath):
-                print('launch "%s"  for  "%s"' % (filepath,  self.winpydir))
-                try:
-                    retcode = subprocess.call('"%s"   "%s"' % (filepath,  self.winpydir),
-                                              shell=True, stdout=sys.stderr)
-                    if retcode < 0:
-                        print("Child was terminated by signal", -retcode, file=sys.stderr)
-                except OSError as e:
-                    print("Execution failed:", e, file=sys.stderr)
+        for filepath in self._get_complement_batch_scripts(this_batch):
+            print('launch "%s"  for  "%s"' % (filepath,  self.winpydir))
+            try:
+                retcode = subprocess.call('"%s"   "%s"' % (filepath,  self.winpydir),
+                                          shell=True, stdout=sys.stderr)
+                if retcode < 0:
+                    print("Child was terminated by signal", -retcode, file=sys.stderr)
+            except OSError as e:
+                print("Execution failed:", e, file=sys.stderr)
 
         self._print_done()
 
-    def make(self, remove_existing=True):
+    def _save_profile(self):
+        """Save build profile next to the distribution directory"""
+        self.profile.save(self.winpydir + '.profile.json')
+
+    def make(self, remove_existing=True, incremental=False, cprofile=False):
         """Make WinPython distribution in target directory from the installers
         located in wheeldir
 
         remove_existing=True: (default) install all from scratch
-        remove_existing=False: only for test purpose (launchers/scripts)"""
+        remove_existing=False: only for test purpose (launchers/scripts)
+        incremental=True: keep existing distribution and only redo the steps
+        whose inputs have changed since previous build (see BuildManifest)
+        cprofile=True: dump build cProfile statistics (<distname>.prof)
+
+        Build profile (see BuildProfile) is saved as <distname>.profile.json
+        in target directory"""
+        self.profile = BuildProfile()
+        profiler = cProfile.Profile() if cprofile else None
+        with self.profile.count_subprocesses():
+            if profiler is not None:
+                profiler.enable()
+            try:
+                self._make(remove_existing, incremental)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                if self.winpydir is not None:
+                    self._save_profile()
+                    if profiler is not None:
+                        profiler.dump_stats(self.winpydir + '.prof')
+
+    def _make(self, remove_existing, incremental):
+        """Make WinPython distribution (see make)"""
         if self.simulation:
             print("WARNING: this is just a simulation!", file=sys.stderr)
 
@@ -1001,65 +1538,115 @@ call %~dp0register_python.bat --all""")
         self.python_fullversion = '.'.join(vlst[:3])
 
         # Create the WinPython base directory
+        self.profile.start_phase('base_directory')
         self._print("Creating WinPython %s base directory"
                     % self.python_version)
         self.winpydir = osp.join(self.target, distname)
+        incremental = incremental and remove_existing and not self.simulation
+        if remove_existing and not self.simulation:
+            # a full build records its steps too, for next incremental build
+            self.manifest = BuildManifest(osp.join(self.target,
+                                                   distname + '.manifest.json'))
+            if not incremental:
+                self.manifest.invalidate('')
         if osp.isdir(self.winpydir) and remove_existing \
-           and not self.simulation:
+           and not incremental and not self.simulation:
             shutil.rmtree(self.winpydir, onerror=utils.onerror)
         if not osp.isdir(self.winpydir):
             os.mkdir(self.winpydir)
-        if remove_existing and not self.simulation:
+        settingsdir = osp.join(self.winpydir, 'settings')
+        if remove_existing and not self.simulation \
+           and not osp.isdir(settingsdir):
             # Create settings directory
             # (only necessary if user is starting an application with a batch
             #  scripts before using an executable launcher, because the latter
             #  is creating the directory automatically)
-            os.mkdir(osp.join(self.winpydir, 'settings'))
+            os.mkdir(settingsdir)
         self._print_done()
 
+        self.profile.start_phase('python')
+        python_uptodate = False
         if remove_existing and not self.simulation:
-            self._extract_python()
+            python_digest = self._get_python_digest()
+            if incremental:
+                python_uptodate = self.manifest.is_uptodate('python',
+                                                            python_digest)
+                if not python_uptodate:
+                    # packages are installed in Python directory
+                    self.manifest.invalidate('package:')
+                    if osp.isdir(self.python_dir):
+                        shutil.rmtree(self.python_dir, onerror=utils.onerror)
+            if not python_uptodate:
+                self._extract_python()
         self.distribution = wppm.Distribution(self.python_dir,
                                               verbose=self.verbose,
                                               indent=True)
+        # Scripts launchers are patched once, see below
+        self.distribution.defer_patch_scripts = True
 
+        self.profile.start_phase('check_packages')
         self._check_packages()
 
         if remove_existing:
-            if not self.simulation:
+            self.profile.start_phase('python_setup')
+            if not self.simulation and not python_uptodate:
                 self._add_msvc_files()
-            if not self.simulation:
                 self._create_batch_scripts_initial()
                 self._run_complement_batch_scripts("run_required_first.bat")
+                if self.manifest is not None:
+                    self.manifest.update('python', python_digest,
+                                         [self.python_dir])
+            self.profile.start_phase('required_packages')
             self._install_required_packages()
+            self.profile.start_phase('other_packages')
             self._install_all_other_packages()
+            self._remove_stale_packages()
             if not self.simulation:
+                self.profile.start_phase('tools')
                 self._copy_dev_tools()
+                self.profile.start_phase('docs')
                 self._copy_dev_docs()
         if not self.simulation:
+            self.profile.start_phase('launchers')
             self._create_launchers()
+            self.profile.start_phase('batch_scripts')
             self._create_batch_scripts()
             self._run_complement_batch_scripts()
+            self.profile.start_phase('patch_scripts')
+            self._print("Patching Scripts launchers")
+            self.distribution.patch_scripts()
+            self._print_done()
 
         if remove_existing and not self.simulation:
+            self.profile.start_phase('clean_up')
             self._print("Cleaning up distribution")
             self.distribution.clean_up()
             self._print_done()
 
-        # Writing package index
-        self._print("Writing package index")
-        fname = osp.join(self.winpydir, os.pardir,
-                         'WinPython%s-%s.txt' % (self.flavor, self.winpyver))
-        open(fname, 'w').write(self.package_index_wiki)
-        # Copy to winpython/changelogs
-        shutil.copyfile(fname, osp.join(CHANGELOGS_DIR, osp.basename(fname)))
-        self._print_done()
+        with OUTPUT_LOCK:
+            # Writing package index
+            self.profile.start_phase('package_index')
+            self._print("Writing package index")
+            fname = osp.join(self.winpydir, os.pardir,
+                             'WinPython%s-%s.txt' % (self.flavor,
+                                                     self.winpyver))
+            open(fname, 'w').write(self.package_index_wiki)
+            # Copy to winpython/changelogs
+            shutil.copyfile(fname, osp.join(CHANGELOGS_DIR,
+                                            osp.basename(fname)))
+            self._print_done()
 
-        # Writing changelog
-        self._print("Writing changelog")
-        diff.write_changelog(self.winpyver, rootdir=self.rootdir,
-                             flavor=self.flavor)
-        self._print_done()
+            # Writing changelog
+            self.profile.start_phase('changelog')
+            self._print("Writing changelog")
+            diff.write_changelog(self.winpyver, rootdir=self.rootdir,
+                                 flavor=self.flavor)
+            self._print_done()
+        self.profile.stop()
+
+        if incremental:
+            print("Build cache report:")
+            print(self.manifest.get_report())
 
 
 def rebuild_winpython(basedir=None, verbose=False, archis=(32, 64)):
@@ -1078,13 +1665,15 @@ def rebuild_winpython(basedir=None, verbose=False, archis=(32, 64)):
 def make_winpython(build_number, release_level, architecture,
                    basedir=None, verbose=False, remove_existing=True,
                    create_installer=True, simulation=False, rootdir=None,
-                   install_options=None, flavor=''):
+                   install_options=None, flavor='', incremental=False,
+                   cprofile=False):
     """Make WinPython distribution, for a given base directory and
     architecture:
 
     make_winpython(build_number, release_level, architecture,
                    basedir=None, verbose=False, remove_existing=True,
-                   create_installer=True, simulation=False)
+                   create_installer=True, simulation=False,
+                   incremental=False, cprofile=False)
 
     `build_number`: build number [int]
     `release_level`: release level (e.g. 'beta1', '') [str]
@@ -1105,20 +1694,16 @@ def make_winpython(build_number, release_level, architecture,
 
     # Create 1 wheel directory to receive all packages whished  for build
     wheeldir = osp.join(builddir, 'wheels_tmp' + suffix)
-    if osp.isdir(wheeldir):
-        shutil.rmtree(wheeldir, onerror=utils.onerror)
-    os.mkdir(wheeldir)
-    #  Copy Every package directory to the wheel directory
+    #  Stage Every package directory in the wheel directory: files are hard
+    #  linked (or cloned, or copied) and only when they have changed
+    #  (flavor packages override base packages with the same file name)
     source_dirs = [osp.join(basedir, 'packages' + suffix),
                    osp.join(basedir, 'packages.src'),
                    osp.join(basedir, flavor, 'packages' + suffix),
                    osp.join(basedir, flavor, 'packages.src')]
-    for m in list(set(source_dirs)):
-        if osp.isdir(m):
-            src_files = os.listdir(m)
-            for file_name in src_files:
-                full_file_name = os.path.join(m, file_name)
-                shutil.copy(full_file_name, wheeldir)
+    stats = utils.stage_directories(source_dirs, wheeldir, verbose=verbose)
+    print("Staging packages: %(link)d linked, %(reflink)d cloned, "
+          "%(copy)d copied, %(kept)d kept, %(removed)d removed" % stats)
 
     # Define List of Tools directory to collect
     toolsdir1 = osp.join(basedir, 'tools')
@@ -1158,7 +1743,8 @@ def make_winpython(build_number, release_level, architecture,
                                  rootdir=rootdir,
                                  install_options=install_options,
                                  flavor=flavor, docsdirs=docsdirs)
-    dist.make(remove_existing=remove_existing)
+    dist.make(remove_existing=remove_existing, incremental=incremental,
+              cprofile=cprofile)
     if create_installer and not simulation:
         dist.create_installer()
     return dist
@@ -1167,11 +1753,12 @@ def make_winpython(build_number, release_level, architecture,
 def make_all(build_number, release_level, pyver,
              rootdir=None, simulation=False, create_installer=True,
              verbose=False, remove_existing=True, archis=(32, 64),
-             install_options=['--no-index'], flavor=''):
+             install_options=['--no-index'], flavor='', incremental=False):
     """Make WinPython for both 32 and 64bit architectures:
 
     make_all(build_number, release_level, pyver, rootdir, simulation=False,
-             create_installer=True, verbose=False, remove_existing=True)
+             create_installer=True, verbose=False, remove_existing=True,
+             incremental=False)
 
     `build_number`: build number [int]
     `release_level`: release level (e.g. 'beta1', '') [str]
@@ -1185,7 +1772,111 @@ def make_all(build_number, release_level, pyver,
         make_winpython(build_number, release_level, architecture, basedir,
                        verbose, remove_existing, create_installer, simulation,
                        rootdir=rootdir, install_options=install_options,
-                       flavor=flavor)
+                       flavor=flavor, incremental=incremental)
+
+
+def _init_matrix_worker(lock):
+    """Initialize make_matrix worker process"""
+    global OUTPUT_LOCK
+    OUTPUT_LOCK = lock
+
+
+def _make_matrix_target(job):
+    """Make one make_matrix target in a worker process, its output being
+    redirected to a log file: return (target, elapsed time, log file name,
+    error traceback or None)"""
+    target, args, kwargs = job
+    pyver, architecture, flavor = target
+    basedir = utils.get_basedir(pyver, rootdir=kwargs['rootdir'])
+    logname = osp.join(basedir, 'build%s-%dbit.log' % (flavor, architecture))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    error = None
+    t0 = time.time()
+    with open(logname, 'w') as log:
+        # subprocesses (pip, NSIS, ...) write to the log file too
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            make_winpython(*args, basedir=basedir, flavor=flavor, **kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            print(error, file=sys.stderr)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+    return target, time.time() - t0, logname, error
+
+
+def make_matrix(build_number, release_level, targets, rootdir=None,
+                processes=None, simulation=False, create_installer=True,
+                verbose=False, remove_existing=True,
+                install_options=['--no-index'], incremental=False):
+    """Make several WinPython distributions in parallel:
+
+    make_matrix(build_number, release_level, targets, rootdir=None,
+                processes=None, ...)
+
+    `targets`: list of (pyver, architecture, flavor) tuples, e.g.
+    [('3.4', 32, ''), ('3.4', 64, ''), ('3.4', 64, 'FlavorRfull')]
+    `processes`: number of builds running at the same time (default: all)
+
+    The winpython package is rebuilt first (once per basedir and
+    architecture), then each target is built by make_winpython in its own
+    process and build directory (basedir/build<flavor>), with its output in
+    basedir/build<flavor>-<arch>bit.log. Package, tools and docs directories
+    are only read. Return the list of (target, elapsed time, log file name,
+    error traceback or None) and print a timing report.
+    (rootdir: root directory containing 'basedir27', 'basedir33', etc.)
+    """ + utils.ROOTDIR_DOC
+    t0 = time.time()
+    archis = {}
+    for pyver, architecture, flavor in targets:
+        assert architecture in (32, 64)
+        archis.setdefault(pyver, set()).add(architecture)
+    for pyver in sorted(archis):
+        basedir = utils.get_basedir(pyver, rootdir=rootdir)
+        rebuild_winpython(basedir=basedir, archis=sorted(archis[pyver]))
+    args = (build_number, release_level)
+    jobs = []
+    for target in targets:
+        kwargs = dict(architecture=target[1], verbose=verbose,
+                      remove_existing=remove_existing,
+                      create_installer=create_installer,
+                      simulation=simulation, rootdir=rootdir,
+                      install_options=install_options,
+                      incremental=incremental)
+        jobs.append((tuple(target), args, kwargs))
+    if processes is None:
+        processes = len(jobs)
+    pool = multiprocessing.Pool(processes, initializer=_init_matrix_worker,
+                                initargs=(multiprocessing.Lock(),))
+    results = []
+    try:
+        for result in pool.imap_unordered(_make_matrix_target, jobs):
+            (pyver, architecture, flavor), elapsed, logname, error = result
+            print("WinPython %s %dbit%s: %s in %.1f s (see %s)"
+                  % (pyver, architecture, flavor,
+                     'FAILED' if error else 'done', elapsed, logname))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t0
+    utils.print_box("Build matrix timing report")
+    for (pyver, architecture, flavor), target_elapsed, _logname, error \
+            in sorted(results, key=lambda result: result[1]):
+        print("%-6s %dbit %-16s %8.1f s  %s"
+              % (pyver, architecture, flavor or '(base)', target_elapsed,
+                 'FAILED' if error else 'OK'))
+    print("Total: %.1f s wall time for %.1f s of builds (%d processes)"
+          % (elapsed, sum(result[1] for result in results), processes))
+    return results
 
 
 if __name__ == '__main__':
@@ -1200,6 +1891,8 @@ if __name__ == '__main__':
     #         verbose=False, archis=(64, ))
     #make_all(8, '', pyver='3.3', rootdir=r'D:\Winpython',
     #          verbose=False, archis=(32, ))
+    #make_matrix(3, '', [('3.4', 32, ''), ('3.4', 64, ''),
+    #                    ('3.4', 64, 'FlavorRfull')], rootdir=r'D:\Winpython')
     #make_all(8, '', pyver='3.3', rootdir=r'D:\Winpython',
     #          verbose=False, archis=(64, ))
     #make_all(5, '', pyver='2.7', rootdir=r'D:\Winpython',
@@ -16,11 +16,26 @@ import sys
 import os
 import os.path as osp
 import re
+import time
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
 
 # Local imports
 from winpython import utils, wppm
 
 
+@contextmanager
+def temp_directory(prefix):
+    """Temporary directory (removed with its contents on exit)"""
+    dirname = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield dirname
+    finally:
+        shutil.rmtree(dirname)
+
+
 def test_python_packages(pyver):
     """Check if all Python packages are supported by WinPython"""
     basedir = utils.get_basedir(pyver)
@@ -36,6 +51,486 @@ def test_python_packages(pyver):
                     print('failed: %s' % name, file=sys.stderr)
 
 
+def benchmark_package_metadata(counts=(10, 100, 1000, 10000)):
+    """Show how `wppm.Package` metadata cost (construction and description
+    lookup) scales with the number of packages (metadata database is parsed
+    once, then memoized)"""
+    t0 = time.time()
+    wppm._METADATA_DB.clear()
+    names = sorted(wppm.get_package_database('packages.ini'))
+    print('packages.ini parsing: %.2f ms' % ((time.time() - t0)*1e3))
+    for count in counts:
+        fnames = ['%s-1.0-py2.py3-none-any.whl' % names[index % len(names)]
+                  for index in range(count)]
+        t0 = time.time()
+        for fname in fnames:
+            wppm.Package(fname).description
+        elapsed = time.time() - t0
+        print('%6d packages: %9.2f ms, %7.1f us/package'
+              % (count, elapsed*1e3, elapsed*1e6/count))
+
+
+def benchmark_installed_distributions(count=500):
+    """Enumerate distributions of a synthetic site-packages tree (dist-info,
+    egg-info directories and files, eggs) by reading their metadata"""
+    with temp_directory('wppm_site-packages_') as sitedir:
+        expected = []
+        for index in range(count):
+            name, version = 'Package_%d' % index, '1.%d' % index
+            expected.append(('package-%d' % index, version))
+            kind = index % 4
+            if kind == 0:
+                path = osp.join(sitedir, '%s-%s.dist-info' % (name, version))
+                os.mkdir(path)
+                fname = osp.join(path, 'METADATA')
+            elif kind == 1:
+                path = osp.join(sitedir, '%s-%s-py3.4.egg-info'
+                                % (name, version))
+                os.mkdir(path)
+                fname = osp.join(path, 'PKG-INFO')
+            elif kind == 2:
+                fname = osp.join(sitedir, '%s-%s-py3.4.egg-info'
+                                 % (name, version))
+            else:
+                path = osp.join(sitedir, '%s-%s-py3.4-win32.egg'
+                                % (name, version))
+                os.makedirs(osp.join(path, 'EGG-INFO'))
+                fname = osp.join(path, 'EGG-INFO', 'PKG-INFO')
+            open(fname, 'w').write('Metadata-Version: 2.0\nName: %s\n'
+                                   'Version: %s\n\nDescription\n'
+                                   % (name, version))
+        os.mkdir(osp.join(sitedir, 'package_0'))
+        t0 = time.time()
+        infos = utils.get_installed_distributions(sitedir)
+        elapsed = time.time() - t0
+        assert infos == sorted(expected), infos
+        print('%d distributions: %.2f ms' % (count, elapsed*1e3))
+
+
+def _legacy_package_infos(bname):
+    """Former `wppm.Package.extract_infos` regex cascade (reference for
+    `benchmark_package_infos`)"""
+    if bname.endswith('.exe'):
+        match = re.match(utils.WININST_PATTERN, bname)
+        if match is not None:
+            name, version, _t0, _qtver, arch, _t1, pyversion, _t2 = \
+                match.groups()
+            return name, version, pyversion, 32 if arch == 'win32' else 64
+        pat = r'([a-zA-Z0-9\-\_]*)-Py([0-9\.]*)-x(64|32)-gpl-([0-9\.\-]*[a-z]*)\.exe'
+        match = re.match(pat, bname)
+        if match is not None:
+            name, pyversion, arch, version = match.groups()
+            return name, version, pyversion, int(arch)
+        pat = r'([a-zA-Z0-9\_]*)-([0-9\.]*[a-z]*)-gpl-Py([0-9\.]*)-.*-x(64|32)\.exe'
+        match = re.match(pat, bname)
+        if match is not None:
+            name, version, pyversion, arch = match.groups()
+            return name, version, pyversion, int(arch)
+        match = re.match(r'([a-zA-Z0-9\-\_]*)-([0-9\.]*[a-z]*)-py([0-9\.]*)-x(64|32)-([a-z0-9\.\-]*).exe', bname)
+        if match is not None:
+            name, version, pyversion, arch, _pyqt = match.groups()
+            return name, version, pyversion, int(arch)
+    elif bname.endswith(('32.whl', '64.whl')):
+        match = re.match(utils.WHEELBIN_PATTERN, bname)
+        if match is not None:
+            name, version, pywheel, arch = match.groups()
+            return (name, version, pywheel[:1] + '.' + pywheel[1:],
+                    32 if arch == 'win32' else 64)
+    elif bname.endswith(('.zip', '.tar.gz', '.whl')):
+        match = re.match(utils.SOURCE_PATTERN, bname)
+        if match is not None:
+            return match.groups()[0], match.groups()[1], None, None
+
+
+def get_changelogs_fnames():
+    """Return package filenames (every supported installer type) for all
+    packages listed in changelogs"""
+    changelogs_dir = osp.join(osp.dirname(osp.abspath(__file__)),
+                              'changelogs')
+    patterns = (r'\[([^\]\(\) ]+)\]\([^\)]*\) \| ([^\|\s]+) \|',
+                r'\[[^\] ]+ ([^\] ]+)\] \|\| ([^\|\s]+) \|\|')
+    templates = ('%s-%s-py2.py3-none-any.whl', '%s-%s-cp34-none-win32.whl',
+                 '%s-%s-cp27-none-win_amd64.whl', '%s-%s.win-amd64-py3.4.exe',
+                 '%s-%s.win32.exe', '%s-%s.tar.gz', '%s-%s.zip',
+                 '%s-%s-gpl-Py3.4-Qt4.8.7-x32.exe',
+                 '%s-%s-py2.7-x64-pyqt4.8.6-numpy1.6.1-1.exe')
+    infos = set()
+    for name in sorted(os.listdir(changelogs_dir)):
+        for line in open(osp.join(changelogs_dir, name), 'rb'):
+            line = line.decode('utf-8', 'replace')
+            for pattern in patterns:
+                match = re.search(pattern, line)
+                if match is not None:
+                    infos.add(match.groups())
+    fnames = []
+    for name, version in sorted(infos):
+        fnames += [template % (name, version) for template in templates]
+        fnames.append('%s-Py3.4-x64-gpl-%s.exe' % (name, version))
+    return fnames
+
+
+def benchmark_package_infos(repeat=5):
+    """Compare package filename classification against the former regex
+    cascade over a corpus built from every package listed in changelogs"""
+    fnames = get_changelogs_fnames()
+    for fname in fnames:
+        infos = utils.get_package_infos(fname)
+        expected = _legacy_package_infos(fname)
+        if infos is None:
+            assert expected is None, fname
+        else:
+            assert tuple(infos[:4]) == expected, (fname, infos, expected)
+    t0 = time.time()
+    for _index in range(repeat):
+        for fname in fnames:
+            _legacy_package_infos(fname)
+    t_legacy = (time.time() - t0)/repeat
+    t0 = time.time()
+    for _index in range(repeat):
+        for fname in fnames:
+            utils._extract_package_infos(fname)
+    t_cold = (time.time() - t0)/repeat
+    t0 = time.time()
+    for _index in range(repeat):
+        for fname in fnames:
+            utils.get_package_infos(fname)
+    t_warm = (time.time() - t0)/repeat
+    print('%d filenames (identical results): legacy %.2f ms, '
+          'compiled %.2f ms, memoized %.2f ms'
+          % (len(fnames), t_legacy*1e3, t_cold*1e3, t_warm*1e3))
+
+
+def benchmark_unpack_wheel(modules=200):
+    """Install a synthetic wheel (site-packages, scripts and data files)
+    into a fake distribution tree, without pip"""
+    with temp_directory('wppm_wheel_') as tmpdir:
+        fname = osp.join(tmpdir, 'foo_bar-1.0-py2.py3-none-any.whl')
+        zfile = zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
+        for index in range(modules):
+            zfile.writestr('foo_bar/module%d.py' % index, 'x = %d\n' % index)
+        zfile.writestr('foo_bar-1.0.data/scripts/foo.py', '#!python\n')
+        zfile.writestr('foo_bar-1.0.data/data/share/foo.txt', 'foo\n')
+        zfile.writestr('foo_bar-1.0.dist-info/METADATA',
+                       'Name: foo-bar\nVersion: 1.0\n')
+        zfile.writestr('foo_bar-1.0.dist-info/WHEEL', 'Wheel-Version: 1.0\n')
+        zfile.writestr('foo_bar-1.0.dist-info/RECORD', '')
+        zfile.close()
+        target = osp.join(tmpdir, 'python')
+        os.makedirs(osp.join(target, 'Lib', 'site-packages'))
+        os.mkdir(osp.join(target, 'Scripts'))
+        assert utils.can_unpack_wheel(fname)
+        t0 = time.time()
+        files = utils.unpack_wheel(fname, target)
+        elapsed = time.time() - t0
+        sitedir = osp.join(target, 'Lib', 'site-packages')
+        record = open(osp.join(sitedir, 'foo_bar-1.0.dist-info', 'RECORD')
+                      ).read().splitlines()
+        assert len(record) == modules + 6, len(record)
+        assert '../../Scripts/foo.py' in [line.split(',')[0]
+                                          for line in record]
+        for relpath in files:
+            assert osp.exists(osp.join(target, relpath)), relpath
+        assert osp.isfile(osp.join(target, 'share', 'foo.txt'))
+        assert utils.get_installed_distributions(sitedir) == \
+            [('foo-bar', '1.0')]
+        print('%d files unpacked: %.2f ms' % (len(files), elapsed*1e3))
+
+
+def benchmark_stage_directories(count=200, size=1 << 16):
+    """Stage two package directories (the second overriding the first) into
+    a wheel directory, then stage them again (nothing to do)"""
+    with temp_directory('wppm_stage_') as tmpdir:
+        source_dirs = [osp.join(tmpdir, 'packages'),
+                       osp.join(tmpdir, 'flavor')]
+        for dirname in source_dirs:
+            os.mkdir(dirname)
+        for index in range(count):
+            dirname = source_dirs[index % 2]
+            with open(osp.join(dirname, 'p%d-1.0.whl' % index), 'wb') as fd:
+                fd.write(b'x' * size)
+        with open(osp.join(source_dirs[1], 'p0-1.0.whl'), 'wb') as fd:
+            fd.write(b'flavor')
+        wheeldir = osp.join(tmpdir, 'wheels_tmp')
+        for run in ('first', 'second'):
+            t0 = time.time()
+            stats = utils.stage_directories(source_dirs, wheeldir)
+            print('%s staging of %d MB: %.2f ms %r'
+                  % (run, count*size >> 20, (time.time() - t0)*1e3, stats))
+        assert stats['kept'] == count, stats
+        assert open(osp.join(wheeldir, 'p0-1.0.whl'), 'rb').read() == \
+            b'flavor'
+
+
+def benchmark_copy_trees(count=5000, size=4096):
+    """Copy a tools directory of many small files (like MinGW), then copy
+    it again (nothing to do), then with one file modified and one removed"""
+    with temp_directory('wppm_copy_') as tmpdir:
+        tooldir = osp.join(tmpdir, 'tools', 'mingw')
+        for index in range(count):
+            dirname = osp.join(tooldir, 'd%d' % (index // 100))
+            if not osp.isdir(dirname):
+                os.makedirs(dirname)
+            with open(osp.join(dirname, 'f%d.h' % index), 'wb') as fd:
+                fd.write(b'x' * size)
+        targetdir = osp.join(tmpdir, 'winpython', 'tools')
+        for run in ('first', 'second', 'third'):
+            if run == 'third':
+                with open(osp.join(tooldir, 'd0', 'f0.h'), 'wb') as fd:
+                    fd.write(b'modified')
+                os.remove(osp.join(tooldir, 'd1', 'f100.h'))
+            stats = utils.copy_trees([osp.join(tmpdir, 'tools')], targetdir)
+            print('%s copy: %s' % (run, utils.get_copy_report(stats)))
+        assert stats['files'] == 1 and stats['removed'] == 1, stats
+        assert stats['kept'] == count - 2, stats
+        assert open(osp.join(targetdir, 'mingw', 'd0', 'f0.h'), 'rb').read() \
+            == b'modified'
+
+
+def _get_process_io():
+    """Return (bytes read, bytes written, page faults) of this process
+    (Linux only: memory-mapped reads are page faults), None if not
+    available"""
+    try:
+        import resource
+        with open('/proc/self/io') as fd:
+            infos = dict(line.split(':') for line in fd)
+    except (ImportError, IOError, OSError):
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (int(infos['rchar']), int(infos['wchar']),
+            usage.ru_minflt + usage.ru_majflt)
+
+
+def _patch_shebang_line_copy(fname, pad=b' '):
+    """Former patch_shebang_line (whole launcher read and written again),
+    for reference"""
+    shebang_line = re.compile(b"(#!.+pythonw?\\.exe)")
+    with open(fname, 'rb') as fh:
+        content = fh.read()
+    content = shebang_line.split(content, maxsplit=1)
+    if len(content) != 3:
+        return
+    exe = os.path.basename(content[1][2:])
+    content[1] = b'#!' + exe + (pad * (len(content[1]) - len(exe) - 2))
+    with open(fname, 'wb') as fh:
+        fh.write(b''.join(content))
+
+
+def benchmark_patch_shebang_line(count=100, size=1 << 18):
+    """Patch a Scripts directory of synthetic launchers (stub, absolute
+    shebang line and zip archive) with the former implementation and with
+    utils.patch_shebang_line (mmap, in place), then patch them again
+    (already relative: nothing is written)"""
+    with temp_directory('wppm_shebang_') as tmpdir:
+        stub = b'MZ' + os.urandom(size)
+        shebang = b'#!c:/winpython/python-3.4.3.amd64/python.exe\r\n'
+        archive = osp.join(tmpdir, 'archive.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('__main__.py', 'import sys\nsys.exit(0)\n')
+        with open(archive, 'rb') as fd:
+            archive = fd.read()
+        for name in ('copy', 'mmap'):
+            os.mkdir(osp.join(tmpdir, name))
+            for index in range(count):
+                fname = osp.join(tmpdir, name, 'script%d.exe' % index)
+                with open(fname, 'wb') as fd:
+                    fd.write(stub + shebang + archive)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # 'patched ...' messages
+        try:
+            results = []
+            for name, patch in (('copy', _patch_shebang_line_copy),
+                                ('copy', _patch_shebang_line_copy),
+                                ('mmap', utils.patch_shebang_line),
+                                ('mmap', utils.patch_shebang_line)):
+                fnames = [osp.join(tmpdir, name, 'script%d.exe' % index)
+                          for index in range(count)]
+                io0, t0 = _get_process_io(), time.time()
+                for fname in fnames:
+                    patch(fname)
+                elapsed, io1 = time.time() - t0, _get_process_io()
+                results.append((name, elapsed, io0, io1))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        for run, (name, elapsed, io0, io1) in enumerate(results):
+            text = '%s patch of %d launchers (%s): %.2f ms' % (
+                ('first', 'second')[run % 2], count, name, elapsed*1e3)
+            if io0 is not None:
+                text += ', %.1f MB read, %.1f MB written, %d page faults' % (
+                    (io1[0] - io0[0]) / 1048576., (io1[1] - io0[1]) / 1048576.,
+                    io1[2] - io0[2])
+            print(text)
+        for name in ('copy', 'mmap'):
+            with open(osp.join(tmpdir, name, 'script0.exe'), 'rb') as fd:
+                data = fd.read()
+            padding = b' ' * (len(shebang) - len(b'#!python.exe\r\n'))
+            assert data == stub + b'#!python.exe' + padding + b'\r\n' + \
+                archive, name
+
+
+def benchmark_check_package_files(count=1000):
+    """Check a synthetic 1000 packages directory listing, with duplicates
+    (differing by '-' or '_'), architecture and Python version mismatches"""
+    fnames = []
+    for index in range(count):
+        if index % 3:
+            fnames.append('pack_%d-1.%d-cp34-none-win_amd64.whl'
+                          % (index, index))
+        else:
+            fnames.append('pack_%d-1.%d-py2.py3-none-any.whl'
+                          % (index, index))
+    fnames += ['foo-bar-1.0.zip', 'foo_bar-1.1-py2.py3-none-any.whl',
+               'baz-1.0.win32-py3.4.exe', 'qux-1.0-cp27-none-win_amd64.whl',
+               'readme.txt']
+    t0 = time.time()
+    issues = utils.check_package_files(fnames, architecture=64,
+                                       pyversion='3.4')
+    elapsed = time.time() - t0
+    assert [(issue.kind, issue.name) for issue in issues] == [
+        ('architecture', 'baz'), ('duplicate', 'foo-bar'),
+        ('pyversion', 'qux'), ('unsupported', None)], issues
+    print('%d packages checked: %.2f ms' % (len(fnames), elapsed*1e3))
+
+
+def test_upload_stream(size=3 << 20):
+    """Check `googlecode_upload.post_upload_request` against a local HTTP
+    server: the body received must be the one of `encode_upload_request`
+    (Python 2 only, like googlecode_upload)"""
+    import httplib
+    import threading
+    import BaseHTTPServer
+    import googlecode_upload
+    received = {}
+
+    class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received['length'] = int(self.headers['Content-Length'])
+            received['body'] = self.rfile.read(received['length'])
+            self.send_response(201)
+            self.send_header('Location', 'http://localhost/files/test.exe')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), UploadHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    try:
+        with temp_directory('wppm_upload_') as dirname:
+            fname = osp.join(dirname, 'WinPython-test.exe')
+            with open(fname, 'wb') as fd:
+                fd.write(os.urandom(size))
+            fields = [('summary', 'WinPython test'), ('label', 'Featured')]
+            progress = []
+            connection = httplib.HTTPConnection('127.0.0.1',
+                                                server.server_port)
+            t0 = time.time()
+            response = googlecode_upload.post_upload_request(
+                connection, '/files', {}, fields, fname,
+                progress=lambda sent, total: progress.append((sent, total)))
+            elapsed = time.time() - t0
+            connection.close()
+            _content_type, body = googlecode_upload.encode_upload_request(
+                fields, fname)
+    finally:
+        thread.join()
+        server.server_close()
+    assert response.status == 201, response.status
+    assert received['length'] == len(body), received['length']
+    assert received['body'] == body
+    assert progress[-1] == (len(body), len(body)), progress[-1]
+    print('upload of %.1f MB: %.2f ms, %d progress calls'
+          % (len(body)/1048576., elapsed*1e3, len(progress)))
+
+
+# Stub NSIS compiler: "compiles" a script by writing its OutFile
+_MAKENSIS_STUB = r"""import io, os.path as osp, re, sys
+nsi = sys.argv[-1]
+with io.open(nsi, encoding='latin-1') as fd:
+    outfile = re.search(r'^OutFile "(.*)"', fd.read(), re.M).group(1)
+with open(osp.join(osp.dirname(nsi), outfile), 'w') as fd:
+    fd.write('stub')
+"""
+
+
+def test_build_launchers():
+    """Build launchers in parallel with a stub NSIS compiler (see
+    WINPYTHON_MAKENSIS in make.py): every launcher must be created, then
+    a second build must be all build manifest cache hits"""
+    with temp_directory('wppm_launchers_') as dirname:
+        stub = osp.join(dirname, 'makensis.py')
+        if os.name == 'nt':
+            exe = osp.join(dirname, 'makensis.bat')
+            with open(exe, 'w') as fd:
+                fd.write('@"%s" "%s" %%*\n' % (sys.executable, stub))
+            header = ''
+        else:
+            exe = stub
+            header = '#!%s\n' % sys.executable
+        with open(stub, 'w') as fd:
+            fd.write(header + _MAKENSIS_STUB)
+        os.chmod(stub, 0o755)
+        previous = os.environ.get('WINPYTHON_MAKENSIS')
+        os.environ['WINPYTHON_MAKENSIS'] = exe
+        try:
+            import make
+            make.NSIS_EXE = make.get_nsis_exe()
+
+            class Distribution(object):
+                architecture = 64
+
+            dist = make.WinPythonDistribution(1, '', dirname, dirname)
+            dist.winpydir = osp.join(dirname, 'WinPython')
+            os.mkdir(dist.winpydir)
+            dist.python_name = 'python-3.4.3.amd64'
+            dist.python_fullversion = '3.4.3'
+            dist.python_version = '3.4'
+            dist.distribution = Distribution()
+            manifest = osp.join(dirname, 'manifest.json')
+            dist.manifest = make.BuildManifest(manifest)
+            t0 = time.time()
+            dist._create_launchers()
+            elapsed = time.time() - t0
+            names = [step.split(':', 1)[1] for step in dist.manifest.misses]
+            assert names and not dist.manifest.hits, dist.manifest.hits
+            missing = [name for name in names
+                       if not osp.isfile(osp.join(dist.winpydir, name))]
+            assert not missing, missing
+            dist.manifest = make.BuildManifest(manifest)
+            t0 = time.time()
+            dist._create_launchers()
+            elapsed_again = time.time() - t0
+            assert not dist.manifest.misses, dist.manifest.misses
+            assert len(dist.manifest.hits) == len(names), dist.manifest.hits
+        finally:
+            if previous is None:
+                os.environ.pop('WINPYTHON_MAKENSIS')
+            else:
+                os.environ['WINPYTHON_MAKENSIS'] = previous
+    print('%d launchers built: %.2f ms, second build (cache hits): %.2f ms'
+          % (len(names), elapsed*1e3, elapsed_again*1e3))
+
+
+def run_benchmarks():
+    """Run all benchmarks (they write temporary files)"""
+    benchmark_package_metadata()
+    benchmark_installed_distributions()
+    benchmark_package_infos()
+    benchmark_unpack_wheel()
+    benchmark_stage_directories()
+    benchmark_copy_trees()
+    benchmark_check_package_files()
+    benchmark_patch_shebang_line()
+    test_build_launchers()
+    if sys.version_info[0] == 2:
+        test_upload_stream()
+
+
 if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        run_benchmarks()
+        sys.exit()
     test_python_packages('2.7')
     test_python_packages('3.3')
\ No newline at end of file
@@ -15,12 +15,13 @@ import os
 import sys
 import platform
 import locale
+import bisect
 
 from winpython.qt.QtGui import (QApplication, QMainWindow, QWidget, QLineEdit,
                                 QHBoxLayout, QVBoxLayout, QColor, QMessageBox,
                                 QAbstractItemView, QProgressDialog, QTableView,
                                 QPushButton, QLabel, QTabWidget, QToolTip,
-                                QDesktopServices)
+                                QDesktopServices, QSortFilterProxyModel)
 from winpython.qt.QtCore import (Qt, QAbstractTableModel, QModelIndex, Signal,
                                  QThread, QTimer, QUrl)
 from winpython.qt.compat import (to_qvariant, getopenfilenames,
@@ -37,7 +38,7 @@ from winpython import wppm, associate, utils
 from winpython.py3compat import getcwd, to_text_string
 
 
-COLUMNS = ACTION, CHECK, NAME, VERSION, DESCRIPTION = list(range(5))
+COLUMNS = ACTION, CHECK, NAME, VERSION, SIZE, DESCRIPTION = list(range(6))
 
 
 class PackagesModel(QAbstractTableModel):
@@ -46,19 +47,54 @@ class PackagesModel(QAbstractTableModel):
 
     def __init__(self):
         QAbstractTableModel.__init__(self)
-        self.packages = []
+        self.packages = []  # sorted by name
+        self.keys = []  # package names, for bisect
+        self.names = {}  # {name: package}
         self.checked = set()
         self.actions = {}
+        self.sizes = {}  # {normalized name: size in bytes}
 
     def sortByName(self):
-        self.packages = sorted(self.packages, key=lambda x: x.name)
-        self.reset()
+        self.set_packages(self.packages)
+
+    def set_packages(self, packages):
+        """Set packages (one package per name: the last one wins)"""
+        self.beginResetModel()
+        self.names = dict((package.name, package) for package in packages)
+        self.packages = sorted(self.names.values(), key=lambda x: x.name)
+        self.keys = [package.name for package in self.packages]
+        self.endResetModel()
+
+    def add_package(self, package):
+        """Insert package at its sorted position, return False if a package
+        with the same name is already there"""
+        if package.name in self.names:
+            return False
+        row = bisect.bisect_right(self.keys, package.name)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.packages.insert(row, package)
+        self.keys.insert(row, package.name)
+        self.names[package.name] = package
+        self.endInsertRows()
+        return True
+
+    def remove_package(self, package):
+        """Remove package (or the package with the same file name)"""
+        pack = self.names.get(package.name)
+        if pack is None or pack.fname != package.fname:
+            return
+        row = bisect.bisect_left(self.keys, package.name)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.packages[row]
+        del self.keys[row]
+        self.names.pop(package.name)
+        self.endRemoveRows()
 
     def flags(self, index):
         if not index.isValid():
             return Qt.ItemIsEnabled
         column = index.column()
-        if column in (NAME, VERSION, ACTION, DESCRIPTION):
+        if column in (NAME, VERSION, ACTION, SIZE, DESCRIPTION):
             return Qt.ItemFlags(QAbstractTableModel.flags(self, index))
         else:
             return Qt.ItemFlags(QAbstractTableModel.flags(self, index) |
@@ -80,10 +116,19 @@ class PackagesModel(QAbstractTableModel):
                 action = self.actions.get(package)
                 if action is not None:
                     return to_qvariant(action)
+            elif column == SIZE:
+                size = self.get_size(package)
+                if size is not None:
+                    return to_qvariant(utils.format_size(size))
             elif column == DESCRIPTION:
                 return to_qvariant(package.description)
+        elif role == Qt.UserRole:
+            # Sort key (see PackagesTable.proxy)
+            if column == SIZE:
+                return to_qvariant(self.get_size(package) or 0)
+            return self.data(index)
         elif role == Qt.TextAlignmentRole:
-            if column == ACTION:
+            if column in (ACTION, SIZE):
                 return to_qvariant(int(Qt.AlignRight | Qt.AlignVCenter))
             else:
                 return to_qvariant(int(Qt.AlignLeft | Qt.AlignVCenter))
@@ -112,10 +157,16 @@ class PackagesModel(QAbstractTableModel):
                 return to_qvariant("Version")
             elif section == ACTION:
                 return to_qvariant("Action")
+            elif section == SIZE:
+                return to_qvariant("Size")
             elif section == DESCRIPTION:
                 return to_qvariant("Description")
         return to_qvariant()
 
+    def get_size(self, package):
+        """Return package disk usage (bytes), None if unknown"""
+        return self.sizes.get(wppm.normalize_name(package.name))
+
     def rowCount(self, index=QModelIndex()):
         return len(self.packages)
 
@@ -144,6 +195,25 @@ UPGRADE_ACTION = 'Upgrade from v'
 NONE_ACTION = '-'
 
 
+class SizesThread(QThread):
+    """Disk usage of installed packages computation thread
+    (see Distribution.get_package_sizes)"""
+    # Signal: distribution and {normalized name: size}
+    sizes_computed = Signal(object, object)
+
+    def __init__(self, parent, distribution):
+        QThread.__init__(self, parent)
+        self.distribution = distribution
+
+    def run(self):
+        try:
+            sizes = self.distribution.get_package_sizes()[0]
+        except Exception:
+            # e.g. distribution being modified: sizes are not shown
+            sizes = {}
+        self.sizes_computed.emit(self.distribution, sizes)
+
+
 class PackagesTable(QTableView):
     # Signals after PyQt4 old SIGNAL removal, to be emitted after package_added event
     package_added = Signal()
@@ -153,14 +223,28 @@ class PackagesTable(QTableView):
         assert process in ('install', 'uninstall')
         self.process = process
         self.model = PackagesModel()
-        self.setModel(self.model)
+        # Rows are filtered by name: descriptions are only extracted from the
+        # package database when their row is displayed
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterKeyColumn(NAME)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.proxy.setSortRole(Qt.UserRole)
+        self.setModel(self.proxy)
         self.winname = winname
         self.repair = False
         self.resizeColumnToContents(0)
         self.setAcceptDrops(process == 'install')
         if process == 'uninstall':
             self.hideColumn(0)
+            # Packages may be sorted by size (click on column header)
+            self.setSortingEnabled(True)
+            self.sortByColumn(NAME, Qt.AscendingOrder)
+        else:
+            self.hideColumn(SIZE)
         self.distribution = None
+        self.sizes_thread = None
+        self.sizes_pending = False  # sizes to be computed again
 
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.verticalHeader().hide()
@@ -170,13 +254,26 @@ class PackagesTable(QTableView):
         # self.model.reset() is deprecated in Qt5
         self.model.beginResetModel()
         self.model.endResetModel()
+        self.resize_columns()
+
+    def resize_columns(self):
         self.horizontalHeader().setStretchLastSection(True)
-        for colnb in (ACTION, CHECK, NAME, VERSION):
+        for colnb in (ACTION, CHECK, NAME, VERSION, SIZE):
             self.resizeColumnToContents(colnb)
 
+    def set_filter(self, text):
+        """Show only packages which name contains text"""
+        self.proxy.setFilterFixedString(text)
+
+    def get_visible_packages(self):
+        """Return packages shown by the table (see set_filter)"""
+        return [self.model.packages[
+                    self.proxy.mapToSource(self.proxy.index(row, 0)).row()]
+                for row in range(self.proxy.rowCount())]
+
     def get_selected_packages(self):
-        """Return selected packages"""
-        return [pack for pack in self.model.packages
+        """Return selected packages (among the visible ones)"""
+        return [pack for pack in self.get_visible_packages()
                 if pack in self.model.checked]
 
     def add_packages(self, fnames):
@@ -194,6 +291,7 @@ class PackagesTable(QTableView):
                     notcompatible.append(bname)
             except NotImplementedError:
                 notsupported.append(bname)
+        self.resize_columns()
         # PyQt4 old SIGNAL: self.emit(SIGNAL('package_added()'))
         self.package_added.emit()
         if notsupported:
@@ -211,22 +309,15 @@ class PackagesTable(QTableView):
                                 QMessageBox.Ok)
 
     def add_package(self, package):
-        for pack in self.model.packages:
-            if pack.name == package.name:
-                return
-        self.model.packages.append(package)
-        self.model.packages.sort(key=lambda x: x.name)
-        self.model.checked.add(package)
-        self.reset_model()
+        if self.model.add_package(package):
+            self.model.checked.add(package)
 
     def remove_package(self, package):
-        self.model.packages = [pack for pack in self.model.packages
-                               if pack.fname != package.fname]
+        self.model.remove_package(package)
         if package in self.model.checked:
             self.model.checked.remove(package)
         if package in self.model.actions:
             self.model.actions.pop(package)
-        self.reset_model()
 
     def refresh_distribution(self, dist):
         self.distribution = dist
@@ -243,19 +334,56 @@ class PackagesTable(QTableView):
                 else:
                     action = UPGRADE_ACTION + pack.version
                 self.model.actions[package] = action
+            if self.model.packages:
+                self.model.dataChanged.emit(
+                    self.model.index(0, ACTION),
+                    self.model.index(len(self.model.packages)-1, ACTION))
+            self.resize_columns()
         else:
-            self.model.packages = self.distribution.get_installed_packages()
-            for package in self.model.packages:
-                self.model.actions[package] = NONE_ACTION
-        self.reset_model()
+            self.model.set_packages(self.distribution.get_installed_packages())
+            self.model.actions = dict((package, NONE_ACTION)
+                                      for package in self.model.packages)
+            self.resize_columns()
+            self.refresh_sizes()
+
+    def refresh_sizes(self):
+        """Compute packages disk usage in a background thread, sizes are
+        shown when available (one computation at a time)"""
+        if self.sizes_thread is not None:
+            self.sizes_pending = True
+            return
+        self.sizes_thread = thread = SizesThread(self, self.distribution)
+        thread.sizes_computed.connect(self.set_sizes)
+        thread.finished.connect(self.sizes_thread_finished)
+        thread.start()
+
+    def sizes_thread_finished(self):
+        self.sizes_thread.deleteLater()
+        self.sizes_thread = None
+        if self.sizes_pending:
+            self.sizes_pending = False
+            self.refresh_sizes()
+
+    def set_sizes(self, distribution, sizes):
+        """Show packages disk usage computed for *distribution*"""
+        if distribution is not self.distribution:
+            return
+        self.model.sizes = sizes
+        if self.model.packages:
+            self.model.dataChanged.emit(
+                self.model.index(0, SIZE),
+                self.model.index(len(self.model.packages)-1, SIZE))
+        self.resize_columns()
 
     def select_all(self):
-        allpk = set(self.model.packages)
-        if self.model.checked == allpk:
-            self.model.checked = set()
+        """Select all visible packages (or unselect them if they are all
+        selected already)"""
+        visible = set(self.get_visible_packages())
+        if visible <= self.model.checked:
+            self.model.checked -= visible
         else:
-            self.model.checked = allpk
-        self.model.reset()
+            self.model.checked |= visible
+        self.reset_model()
 
     def dragMoveEvent(self, event):
         """Reimplement Qt method, just to avoid default drag'n drop
@@ -338,24 +466,52 @@ class DistributionSelector(QWidget):
 
 
 class Thread(QThread):
-    """Installation/Uninstallation thread"""
-    def __init__(self, parent):
+    """Installation/Uninstallation thread: packages are processed one after
+    the other (pip and the distribution logs do not support concurrent
+    changes), or all at once by a single callback call if *batch* is True,
+    progress is reported with signals"""
+    # Signals: package index, then package index and error (None if none)
+    package_started = Signal(int)
+    package_done = Signal(int, object)
+
+    def __init__(self, parent, callback, packages, batch=False):
         QThread.__init__(self, parent)
-        self.callback = None
-        self.error = None
-
-    def run(self):
+        self.callback = callback
+        self.packages = packages
+        self.batch = batch
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel operation: package being processed is completed, the
+        following ones are skipped"""
+        self.cancelled = True
+
+    def process(self, arg):
+        """Call callback: return error message, None if successful"""
         try:
-            self.callback()
-        except Exception as error:
-            error_str = str(error)
+            self.callback(arg)
+        except Exception as exc:
+            error = str(exc)
             fs_encoding = sys.getfilesystemencoding()\
                           or locale.getpreferredencoding()
             try:
-                error_str = error_str.decode(fs_encoding)
+                error = error.decode(fs_encoding)
             except (UnicodeError, TypeError, AttributeError):
                 pass
-            self.error = error_str
+            return error
+
+    def run(self):
+        if self.batch:
+            # A single call: done is signaled for the last package only
+            self.package_started.emit(0)
+            self.package_done.emit(len(self.packages) - 1,
+                                   self.process(self.packages))
+            return
+        for index, package in enumerate(self.packages):
+            if self.cancelled:
+                break
+            self.package_started.emit(index)
+            self.package_done.emit(index, self.process(package))
 
 
 def python_distribution_infos():
@@ -383,6 +539,8 @@ class PMWindow(QMainWindow):
         self.untable = None
 
         self.basedir = None
+        self.thread = None
+        self.progress = None
 
         self.select_all_action = None
         self.install_action = None
@@ -397,6 +555,16 @@ class PMWindow(QMainWindow):
         widget = QWidget()
         tabvlayout = QVBoxLayout()
         widget.setLayout(tabvlayout)
+        filter_edit = QLineEdit()
+        filter_edit.setPlaceholderText("Filter packages by name")
+        # Filtering when user stops typing
+        filter_timer = QTimer(widget)
+        filter_timer.setSingleShot(True)
+        filter_timer.setInterval(250)
+        filter_edit.textChanged.connect(lambda text: filter_timer.start())
+        filter_timer.timeout.connect(
+            lambda: table.set_filter(to_text_string(filter_edit.text())))
+        tabvlayout.addWidget(filter_edit)
         tabvlayout.addWidget(table)
         btn_layout = QHBoxLayout()
         tabvlayout.addLayout(btn_layout)
@@ -613,7 +781,7 @@ class PMWindow(QMainWindow):
 
     def distribution_changed(self, path):
         """Distribution path has just changed"""
-        for package in self.table.model.packages:
+        for package in list(self.table.model.packages):
             self.table.remove_package(package)
         dist = wppm.Distribution(to_text_string(path))
         self.table.refresh_distribution(dist)
@@ -644,7 +812,7 @@ class PMWindow(QMainWindow):
             self.table.remove_package(package)
 
     def process_packages(self, action):
-        """Install/uninstall packages"""
+        """Install/uninstall packages in a background thread"""
         if action == 'install':
             text, table = 'Installing', self.table
             if not self.get_packages_to_be_installed():
@@ -653,52 +821,72 @@ class PMWindow(QMainWindow):
             text, table = 'Uninstalling', self.untable
         else:
             raise AssertionError
-        packages = table.get_selected_packages()
-        if not packages:
+        packages = [package for package in table.get_selected_packages()
+                    if package in table.model.actions]
+        if not packages or self.thread is not None:
             return
-        func = getattr(self.distribution, action)
-        thread = Thread(self)
         for widget in self.children():
             if isinstance(widget, QWidget):
                 widget.setEnabled(False)
-        try:
+        self.progress = progress = QProgressDialog(self,
+                                                   Qt.FramelessWindowHint)
+        progress.setMaximum(len(packages))
+        progress.setValue(0)
+        # Packages are uninstalled at once (see Distribution.uninstall_many)
+        batch = action == 'uninstall'
+        if batch:
+            callback = self.distribution.uninstall_many
+        else:
+            callback = self.distribution.install
+        self.thread = thread = Thread(self, callback, packages, batch=batch)
+        if batch:
+            # a single call: it can't be cancelled
+            progress.setCancelButton(None)
+
+        def package_started(index):
+            package = packages[index]
+            if batch:
+                progress.setLabelText("%s %d packages..."
+                                      % (text, len(packages)))
+            else:
+                progress.setLabelText("%s %s %s..."
+                                      % (text, package.name, package.version))
+
+        def package_done(index, error):
+            done = packages[:index + 1] if batch else [packages[index]]
+            for package in done:
+                table.remove_package(package)
+            progress.setValue(index + 1)
+            if error is not None:
+                pstr = ', '.join(package.name + ' ' + package.version
+                                 for package in done)
+                QMessageBox.critical(self, "Error",
+                                     "<b>Unable to %s <i>%s</i></b>"
+                                     "<br><br>Error message:<br>%s"
+                                     % (action, pstr, error))
+
+        def canceled():
+            thread.cancel()
             status = self.statusBar()
-        except AttributeError:
-            status = self.parent().statusBar()
-        progress = QProgressDialog(self, Qt.FramelessWindowHint)
-        progress.setMaximum(len(packages)-1)
-        for index, package in enumerate(packages):
-            progress.setValue(index)
-            progress.setLabelText("%s %s %s..."
-                                  % (text, package.name, package.version))
-            QApplication.processEvents()
-            if progress.wasCanceled():
-                break
-            if package in table.model.actions:
-                try:
-                    thread.callback = lambda: func(package)
-                    thread.start()
-                    while thread.isRunning():
-                        QApplication.processEvents()
-                        if progress.wasCanceled():
-                            status.setEnabled(True)
-                            status.showMessage("Cancelling operation...")
-                    table.remove_package(package)
-                    error = thread.error
-                except Exception as error:
-                    error = to_text_string(error)
-                if error is not None:
-                    pstr = package.name + ' ' + package.version
-                    QMessageBox.critical(self, "Error",
-                                         "<b>Unable to %s <i>%s</i></b>"
-                                         "<br><br>Error message:<br>%s"
-                                         % (action, pstr, error))
-        progress.setValue(progress.maximum())
-        status.clearMessage()
+            status.setEnabled(True)
+            status.showMessage("Cancelling operation...")
+
+        thread.package_started.connect(package_started)
+        thread.package_done.connect(package_done)
+        thread.finished.connect(self.packages_processed)
+        progress.canceled.connect(canceled)
+        thread.start()
+
+    def packages_processed(self):
+        """Background install/uninstall thread has just finished"""
+        self.progress.setValue(self.progress.maximum())
+        self.progress = None
+        self.statusBar().clearMessage()
         for widget in self.children():
             if isinstance(widget, QWidget):
                 widget.setEnabled(True)
-        thread = None
+        self.thread.deleteLater()
+        self.thread = None
         for table in (self.table, self.untable):
             table.refresh_distribution(self.distribution)
 
@@ -24,9 +24,29 @@ import atexit
 import sys
 import stat
 import locale
+import io
+import json
+import base64
+import hashlib
+import time
+import mmap
+import struct
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir  # Python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir  # backport (optional)
+    except ImportError:
+        scandir = None
 
 # Local imports
-from winpython.py3compat import winreg
+try:
+    from winpython.py3compat import winreg
+except ImportError:
+    # Not on Windows: only file-based utilities are available
+    winreg = None
 
 
 # Development only
@@ -205,6 +225,35 @@ def print_box(text):
     print(("\n\n" + "\n".join([line0, line1, line0]) + "\n"))
 
 
+def write_file_if_changed(fname, contents):
+    """Write text file *fname* unless it already contains *contents*:
+    return True if file was written"""
+    try:
+        with open(fname, 'r') as fd:
+            if fd.read() == contents:
+                return False
+    except (IOError, OSError, UnicodeError):
+        pass
+    with open(fname, 'w') as fd:
+        fd.write(contents)
+    return True
+
+
+def parallel_map(func, items, processes=8, chunksize=None):
+    """Return [func(item) for item in items], calling func in a pool of (at
+    most) *processes* threads, or serially if there is only one item or one
+    process"""
+    items = list(items)
+    if processes > 1 and len(items) > 1:
+        pool = ThreadPool(min(processes, len(items)))
+        try:
+            return pool.map(func, items, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return [func(item) for item in items]
+
+
 def is_python_distribution(path):
     """Return True if path is a Python distribution"""
     # XXX: This test could be improved but it seems to be sufficient
@@ -260,56 +309,168 @@ def python_query(cmd, path):
     return exec_shell_cmd('python -c "%s"' % cmd, path).splitlines()[0]
 
 
+# PYTHON_PROBE is run by the Python interpreter of a distribution (2.7, 3.x)
+PYTHON_PROBE = """
+import json, os, sys, sysconfig
+platform = sysconfig.get_platform()
+print(json.dumps({
+    'version': '%d.%d' % sys.version_info[:2],
+    'long_version': '%d.%d.%d' % sys.version_info[:3],
+    'architecture': 64 if sys.maxsize > 2**32 else 32,
+    'platform': platform,
+    'tags': ['cp%d%d' % sys.version_info[:2], 'none',
+             platform.replace('-', '_').replace('.', '_')],
+    'site_packages': os.path.relpath(sysconfig.get_paths()['purelib'],
+                                     sys.prefix)}))
+"""
+PYTHON_PROBE_CACHE = '.wppm_python.json'
+_PYTHON_PROBES = {}  # {path: (key, infos)}
+
+
+def get_pip_version(sitedir):
+    """Return version of pip installed in *sitedir* (read from its metadata
+    directory name), None if pip is not installed"""
+    try:
+        names = os.listdir(sitedir)
+    except OSError:
+        return
+    for name in names:
+        match = METADATA_DIR_PATTERN.match(name)
+        if match is not None and match.group(1).lower() == 'pip':
+            return match.group(2)
+
+
+def get_python_probe(path):
+    """Return a dictionary describing the Python distribution located in
+    *path*: version ('3.4'), long_version ('3.4.3'), architecture (32 or 64),
+    platform ('win-amd64'), tags (wheel tags: ['cp34', 'none', 'win_amd64']),
+    site_packages (full path) and pip_version (None if pip is not installed)
+
+    The interpreter is launched once: the result is cached in memory and in
+    *path* (PYTHON_PROBE_CACHE), keyed by python.exe size and mtime"""
+    exe = osp.join(path, 'python.exe')
+    exe_stat = os.stat(exe)
+    key = [exe_stat.st_size, exe_stat.st_mtime]
+    infos = None
+    if path in _PYTHON_PROBES and _PYTHON_PROBES[path][0] == key:
+        infos = _PYTHON_PROBES[path][1]
+    else:
+        cache_fname = osp.join(path, PYTHON_PROBE_CACHE)
+        try:
+            with open(cache_fname) as fd:
+                contents = json.load(fd)
+            if contents['key'] == key:
+                infos = contents['infos']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        if infos is None:
+            process = subprocess.Popen([exe, '-c', PYTHON_PROBE], cwd=path,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                raise RuntimeError("Failed to probe Python interpreter %s"
+                                   % exe)
+            infos = json.loads(decode_fs_string(output))
+            try:
+                with open(cache_fname, 'w') as fd:
+                    json.dump({'key': key, 'infos': infos}, fd)
+            except (IOError, OSError):
+                # read-only distribution
+                pass
+        _PYTHON_PROBES[path] = (key, infos)
+    infos = dict(infos)
+    # relative path: distribution is portable
+    infos['site_packages'] = osp.join(path, infos['site_packages'])
+    # pip may have been upgraded since probe
+    infos['pip_version'] = get_pip_version(infos['site_packages'])
+    return infos
+
+
 def get_python_infos(path):
     """Return (version, architecture) for the Python distribution located in
     *path*. The version number is limited to MAJOR.MINOR, the architecture is
     an integer: 32 or 64"""
-    is_64 = python_query('import sys; print(sys.maxsize > 2**32)', path)
-    arch = {'True': 64, 'False': 32}.get(is_64, None)
-    ver = python_query("import sys; print('%d.%d' % (sys.version_info.major, "
-                       "sys.version_info.minor))", path)
-    if re.match(r'([0-9]*)\.([0-9]*)', ver) is None:
-        ver = None
-    return ver, arch
+    try:
+        infos = get_python_probe(path)
+    except (OSError, RuntimeError, ValueError):
+        return None, None
+    return infos['version'], infos['architecture']
 
 
 def get_python_long_version(path):
     """Return long version (X.Y.Z) for the Python distribution located in
     *path*"""
-    ver = python_query("import sys; print('%d.%d.%d' % "
-                       "(sys.version_info.major, sys.version_info.minor,"
-                       "sys.version_info.micro))", path)
-    if re.match(r'([0-9]*)\.([0-9]*)\.([0-9]*)', ver) is None:
-        ver = None
-    return ver
+    try:
+        return get_python_probe(path)['long_version']
+    except (OSError, RuntimeError, ValueError):
+        return None
 
 
 # =============================================================================
 # Patch chebang line (courtesy of Christoph Gohlke)
 # =============================================================================
-def patch_shebang_line(fname, pad=b' '):
-    """Remove absolute path to python.exe in shebang lines."""
-    if sys.version_info[0] == 2:
-        shebang_line = re.compile(r"(#!.+pythonw?\.exe)")  # Python2.7
-    else:
-        shebang_line = re.compile(b"(#!.+pythonw?\.exe)")  # Python3+
+SHEBANG_LINE = re.compile(b"#!.+pythonw?\\.exe")
+SHEBANG_SEARCH_SIZE = 1024  # shebang is located just before zip archive
+ZIP_EOCD = struct.Struct('<4s4H2LH')  # zip end of central directory record
+
+
+def _get_shebang_range(data):
+    """Return (start, end) of the region of launcher *data* (an mmap) which
+    contains the shebang line: the region before the zip archive appended
+    to the launcher, the whole data if there is no such archive"""
+    size = len(data)
+    pos = data.rfind(b'PK\x05\x06', max(0, size - ZIP_EOCD.size - 65535))
+    if pos != -1 and pos + ZIP_EOCD.size <= size:
+        fields = ZIP_EOCD.unpack(data[pos:pos + ZIP_EOCD.size])
+        cd_size, cd_offset = fields[5:7]
+        # offsets are relative to archive start
+        start = pos - cd_size - cd_offset
+        if start >= 0:
+            return max(0, start - SHEBANG_SEARCH_SIZE), start
+    return 0, size
 
-    with open(fname, 'rb') as fh:
-        content = fh.read()
-
-    content = shebang_line.split(content, maxsplit=1)
-    if len(content) != 3:
-        return
-    exe = os.path.basename(content[1][2:])
-    content[1] = b'#!' + exe + (pad * (len(content[1]) - len(exe) - 2))
-    content = b''.join(content)
 
+def patch_shebang_line(fname, pad=b' '):
+    """Remove absolute path to python.exe in shebang lines.
+    The launcher is patched in place (same length shebang line, padded
+    with *pad*) through a memory map and is not written at all if its
+    shebang line is already relative: return True if launcher was patched"""
+    with open(fname, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return False
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start, end = _get_shebang_range(data)
+            match = SHEBANG_LINE.search(data, start, end)
+            if match is None:
+                return False
+            shebang = match.group()
+        finally:
+            data.close()
+    exe = os.path.basename(shebang[2:])
+    if shebang[2:] == exe:
+        return False
+    patched = b'#!' + exe + (pad * (len(shebang) - len(exe) - 2))
     try:
-        with open(fname, 'wb') as fh:
-            fh.write(content)
+        with open(fname, 'r+b') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_WRITE)
+            try:
+                data[match.start():match.end()] = patched
+                data.flush()
+            finally:
+                data.close()
             print("patched", fname)
     except Exception:
         print("failed to patch", fname)
+        return False
+    return True
+
+
+def patch_shebang_lines(fnames, processes=8):
+    """Patch shebang lines of launchers *fnames* in parallel
+    (see patch_shebang_line)"""
+    parallel_map(patch_shebang_line, fnames, processes)
 
 
 # =============================================================================
@@ -423,8 +584,7 @@ def extract_msi(fname, targetdir=None, verbose=False):
         # We patch ensurepip live (shame) !!!!
         # rational: https://github.com/pypa/pip/issues/2328
         import glob
-        for fname in glob.glob(r'%s\Scripts\*.exe' % targetdir):
-            patch_shebang_line(fname)
+        patch_shebang_lines(glob.glob(r'%s\Scripts\*.exe' % targetdir))
     return targetdir
 
 
@@ -468,6 +628,199 @@ def extract_archive(fname, targetdir=None, verbose=False):
     return targetdir
 
 
+# =============================================================================
+# Staging functions
+# =============================================================================
+FICLONE = 0x40049409  # Linux ioctl cloning file extents (Btrfs, XFS...)
+
+
+def reflink(src, dst):
+    """Create dst as a copy-on-write clone of src: raise an exception
+    (ImportError, IOError or OSError) if not supported by the platform or
+    by the filesystem"""
+    import fcntl  # not on Windows
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        if osp.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst):
+    """Create file dst with src contents, without copying them if possible:
+    hard link first, then copy-on-write clone and copy as a last resort.
+    Return the method used: 'link', 'reflink' or 'copy'"""
+    try:
+        os.link(src, dst)
+        return 'link'
+    except (AttributeError, OSError):
+        # no os.link (Python 2 on Windows), other volume, FAT filesystem...
+        pass
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except (ImportError, IOError, OSError):
+        pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def is_same_stat(stat1, stat2):
+    """Return True if both os.stat results have same size and mtime
+    (Python 2 copies mtime as a float, hence the one millisecond window)"""
+    return stat1.st_size == stat2.st_size and \
+        abs(stat1.st_mtime - stat2.st_mtime) < 1e-3
+
+
+def stage_directories(source_dirs, targetdir, verbose=False):
+    """Merge the files of source_dirs into targetdir with link_or_copy
+    (a file overrides the same named file of previous source directories).
+    Files already up-to-date in targetdir (same size and mtime) are kept,
+    the others are removed.
+    Return the number of files per action: {'link': 3, 'kept': 2, ...}"""
+    sources = {}
+    for dirname in source_dirs:
+        if osp.isdir(dirname):
+            for name in os.listdir(dirname):
+                path = osp.join(dirname, name)
+                if osp.isfile(path):
+                    sources[name] = path
+    if not osp.isdir(targetdir):
+        os.makedirs(targetdir)
+    stats = dict.fromkeys(('link', 'reflink', 'copy', 'kept', 'removed'), 0)
+    for name in os.listdir(targetdir):
+        path = osp.join(targetdir, name)
+        if name not in sources or not osp.isfile(path):
+            if osp.isdir(path):
+                shutil.rmtree(path, onerror=onerror)
+            else:
+                os.remove(path)
+            stats['removed'] += 1
+    for name, src in sorted(sources.items()):
+        dst = osp.join(targetdir, name)
+        if osp.isfile(dst):
+            if is_same_stat(os.stat(src), os.stat(dst)):
+                stats['kept'] += 1
+                continue
+            os.remove(dst)
+        action = link_or_copy(src, dst)
+        stats[action] += 1
+        if verbose:
+            print('%s --> %s (%s)' % (src, dst, action))
+    return stats
+
+
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def copy_file(src, dst, buffer_size=COPY_BUFFER_SIZE):
+    """Copy file src to dst (data and stat infos, like shutil.copy2) with
+    os.sendfile if available or large buffers otherwise"""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            sendfile = getattr(os, 'sendfile', None)  # Python 3.3+, not Windows
+            offset = 0
+            if sendfile is not None:
+                try:
+                    while True:
+                        sent = sendfile(fdst.fileno(), fsrc.fileno(),
+                                        offset, buffer_size)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except OSError:
+                    if offset:
+                        raise
+                    sendfile = None
+            if sendfile is None:
+                shutil.copyfileobj(fsrc, fdst, buffer_size)
+    shutil.copystat(src, dst)
+
+
+def _get_tree_files(source_dirs):
+    """Return ({relative directory: None}, {relative path: source path}) of
+    the entries of source_dirs merged together (an entry overrides the same
+    named entry of previous source directories)"""
+    dirs, files = {}, {}
+    for dirname in source_dirs:
+        for name in os.listdir(dirname):
+            path = osp.join(dirname, name)
+            if not osp.isdir(path):
+                files[name] = path
+                continue
+            for root, subdirs, fnames in os.walk(path, followlinks=True):
+                relroot = osp.join(name, osp.relpath(root, path))
+                dirs[osp.normpath(relroot)] = None
+                for fname in fnames:
+                    files[osp.normpath(osp.join(relroot, fname))] = \
+                        osp.join(root, fname)
+    return dirs, files
+
+
+def copy_trees(source_dirs, targetdir, processes=8, verbose=False):
+    """Copy the entries of source_dirs into targetdir, files being copied
+    in parallel by a pool of *processes* threads.
+    Files already up-to-date in targetdir (same size and mtime) are kept,
+    files and directories not found in source_dirs are removed.
+    Return stats: {'files': 10, 'bytes': 1024, 'kept': 3, 'removed': 1,
+    'seconds': 0.1}"""
+    t0 = time.time()
+    dirs, files = _get_tree_files(source_dirs)
+    stats = dict(files=0, bytes=0, kept=0, removed=0)
+    jobs = []
+    if osp.isdir(targetdir):
+        for root, subdirs, fnames in os.walk(targetdir, topdown=True):
+            relroot = osp.relpath(root, targetdir)
+            for name in list(subdirs):
+                relpath = osp.normpath(osp.join(relroot, name))
+                if relpath not in dirs:
+                    shutil.rmtree(osp.join(root, name), onerror=onerror)
+                    subdirs.remove(name)
+                    stats['removed'] += 1
+            for name in fnames:
+                relpath = osp.normpath(osp.join(relroot, name))
+                if relpath not in files:
+                    os.remove(osp.join(root, name))
+                    stats['removed'] += 1
+    else:
+        os.makedirs(targetdir)
+    for relpath in sorted(dirs):
+        path = osp.join(targetdir, relpath)
+        if not osp.isdir(path):
+            os.makedirs(path)
+    for relpath, src in sorted(files.items()):
+        dst = osp.join(targetdir, relpath)
+        src_stat = os.stat(src)
+        if osp.isfile(dst) and is_same_stat(src_stat, os.stat(dst)):
+            stats['kept'] += 1
+            continue
+        jobs.append((src, dst))
+        stats['files'] += 1
+        stats['bytes'] += src_stat.st_size
+
+    def copy(job):
+        copy_file(*job)
+        if verbose:
+            print('%s --> %s' % job)
+    parallel_map(copy, jobs, processes, chunksize=16)
+    stats['seconds'] = time.time() - t0
+    return stats
+
+
+def get_copy_report(stats):
+    """Return copy_trees stats as text (throughput in MB/s and files/s)"""
+    seconds = max(stats['seconds'], 1e-6)
+    return ('%d file(s), %.1f MB copied in %.2f s (%.1f MB/s, %.0f files/s), '
+            '%d kept, %d removed'
+            % (stats['files'], stats['bytes'] / 1048576., stats['seconds'],
+               stats['bytes'] / 1048576. / seconds, stats['files'] / seconds,
+               stats['kept'], stats['removed']))
+
+
 WININST_PATTERN = r'([a-zA-Z0-9\-\_]*|[a-zA-Z\-\_\.]*)-([0-9\.\-]*[a-z]*[0-9]?)(-Qt-([0-9\.]+))?.(win32|win\-amd64)(-py([0-9\.]+))?(-setup)?\.exe'
 
 # SOURCE_PATTERN defines what an acceptable source package name is
@@ -484,13 +837,379 @@ SOURCE_PATTERN = r'([a-zA-Z0-9\-\_\.]*)-([0-9\.\_]*[a-z]*[0-9]?)(\.zip|\.tar\.gz
 # "win32|win\_amd64" to replace per "win\_amd64" for 64bit
 WHEELBIN_PATTERN = r'([a-zA-Z0-9\-\_\.]*)-([0-9\.\_]*[a-z0-9\+]*[0-9]?)-cp([0-9]*)\-none\-(win32|win\_amd64)\.whl'
 
+# NSIS_PATTERNS defines acceptable NSIS installers (PyQt4, PyQwt): pattern,
+# literal text required for a match (cheap pre-filter) and the indexes of
+# (name, version, pyversion, architecture) in pattern groups
+NSIS_PATTERNS = (
+    # PyQt-Py2.7-x32-gpl-4.8.6-1.exe
+    (r'([a-zA-Z0-9\-\_]*)-Py([0-9\.]*)-x(64|32)-gpl-([0-9\.\-]*[a-z]*)\.exe',
+     '-gpl-', (0, 3, 1, 2)),
+    # PyQt4-4.10.4-gpl-Py3.4-Qt4.8.6-x32.exe
+    (r'([a-zA-Z0-9\_]*)-([0-9\.]*[a-z]*)-gpl-Py([0-9\.]*)-.*-x(64|32)\.exe',
+     '-gpl-Py', (0, 1, 2, 3)),
+    # PyQwt-5.2.0-py2.6-x64-pyqt4.8.6-numpy1.6.1-1.exe
+    (r'([a-zA-Z0-9\-\_]*)-([0-9\.]*[a-z]*)-py([0-9\.]*)-x(64|32)-([a-z0-9\.\-]*).exe',
+     '-py', (0, 1, 2, 3)),
+    )
+
+_WININST_RE = re.compile(WININST_PATTERN)
+_NSIS_RES = [(re.compile(pattern), required, order)
+             for pattern, required, order in NSIS_PATTERNS]
+_WHEELBIN_RE = re.compile(WHEELBIN_PATTERN)
+_SOURCE_RE = re.compile(SOURCE_PATTERN)
+
+
 def get_source_package_infos(fname):
     """Return a tuple (name, version) of the Python source package"""
-    match = re.match(SOURCE_PATTERN, osp.basename(fname))
+    match = _SOURCE_RE.match(osp.basename(fname))
     if match is not None:
         return match.groups()[:2]
 
 
+# Package infos extracted from installer filename:
+#   `kind`: 'wininst', 'nsis', 'wheel' (binary wheel) or 'source' (source
+#   distribution or pure Python wheel)
+PackageInfos = namedtuple('PackageInfos', ['name', 'version', 'pyversion',
+                                           'architecture', 'kind'])
+
+# Memoized package infos: {basename: PackageInfos or None}
+_PACKAGE_INFOS = {}
+
+
+def _extract_package_infos(bname):
+    """Return PackageInfos of package installer *bname* (see
+    `get_package_infos`)"""
+    if bname.endswith('.exe'):
+        # distutils bdist_wininst
+        match = None
+        if 'win32' in bname or 'win-amd64' in bname:
+            match = _WININST_RE.match(bname)
+        if match is not None:
+            (name, version, _t0, _qtver, arch, _t1, pyversion, _t2
+             ) = match.groups()
+            return PackageInfos(name, version, pyversion,
+                                32 if arch == 'win32' else 64, 'wininst')
+        # NSIS
+        for regexp, required, order in _NSIS_RES:
+            match = regexp.match(bname) if required in bname else None
+            if match is not None:
+                groups = match.groups()
+                name, version, pyversion, arch = [groups[i] for i in order]
+                return PackageInfos(name, version, pyversion, int(arch),
+                                    'nsis')
+    elif bname.endswith(('32.whl', '64.whl')):
+        # Binary wheel, e.g. ('scipy', '0.14.1rc1', '34', 'win32')
+        match = _WHEELBIN_RE.match(bname) if '-cp' in bname else None
+        if match is not None:
+            name, version, pywheel, arch = match.groups()
+            # wheel Python version is '34', not '3.4'
+            return PackageInfos(name, version, pywheel[:1] + '.' + pywheel[1:],
+                                32 if arch == 'win32' else 64, 'wheel')
+    elif bname.endswith(('.zip', '.tar.gz', '.whl')):
+        # distutils sdist or pure Python wheel
+        match = _SOURCE_RE.match(bname)
+        if match is not None:
+            name, version = match.groups()[:2]
+            return PackageInfos(name, version, None, None, 'source')
+
+
+def get_package_infos(fname):
+    """Return PackageInfos (name, version, pyversion, architecture, kind)
+    of package installer *fname*, None if package type is not supported
+
+    Filename patterns are selected by extension, results are memoized"""
+    bname = osp.basename(fname)
+    try:
+        return _PACKAGE_INFOS[bname]
+    except KeyError:
+        infos = _PACKAGE_INFOS[bname] = _extract_package_infos(bname)
+        return infos
+
+
+# PackageIssue: kind is 'unsupported' (name is None), 'duplicate',
+# 'architecture' or 'pyversion'
+PackageIssue = namedtuple('PackageIssue', ['kind', 'name', 'fnames'])
+
+
+def check_package_files(fnames, architecture=None, pyversion=None):
+    """Check package files in a single pass, grouping them by project key
+    (so that 'foo-bar' and 'foo_bar' are the same project).
+    Return the sorted list of PackageIssue:
+        'unsupported': file name is not a supported package
+        'duplicate': more than one file for a project
+        'architecture': files not for *architecture* (32 or 64), or mixed
+                        architectures for a project if *architecture* is None
+        'pyversion': same thing for Python version (e.g. '3.4')
+    Files without architecture or Python version (pure Python) always
+    pass these two checks"""
+    issues = []
+    projects = {}
+    for fname in fnames:
+        infos = get_package_infos(fname)
+        if infos is None:
+            issues.append(PackageIssue('unsupported', None, [fname]))
+        else:
+            projects.setdefault(get_distribution_key(infos.name), []
+                                ).append((fname, infos))
+    for key, files in projects.items():
+        if len(files) > 1:
+            issues.append(PackageIssue('duplicate', key,
+                                       [fname for fname, _infos in files]))
+        for kind, expected in (('architecture', architecture),
+                               ('pyversion', pyversion)):
+            values = [(fname, getattr(infos, kind)) for fname, infos in files
+                      if getattr(infos, kind) is not None]
+            if expected is not None:
+                wrong = [fname for fname, value in values if value != expected]
+            elif len(set(value for _fname, value in values)) > 1:
+                wrong = [fname for fname, _value in values]
+            else:
+                wrong = []
+            if wrong:
+                issues.append(PackageIssue(kind, key, wrong))
+    return sorted(issues, key=lambda issue: (issue.kind, issue.name or '',
+                                             issue.fnames))
+
+
+# =============================================================================
+# Installed distributions (reading metadata directly from site-packages)
+# =============================================================================
+# METADATA_DIR_PATTERN defines installed distributions metadata entries:
+#    - foo_bar-1.0.dist-info (wheel, pip)
+#    - foo_bar-1.0-py3.4.egg-info (setuptools, distutils: directory or file)
+#    - foo_bar-1.0-py3.4.egg (easy_install)
+METADATA_DIR_PATTERN = re.compile(
+    r'([^-]+)-([^-]+)(-py[0-9\.]+)?(-[^-]+)?\.(dist-info|egg-info|egg)$')
+
+
+def get_distribution_key(name):
+    """Return pip/pkg_resources key of project *name* (e.g. 'foo-bar')"""
+    return re.sub('[^A-Za-z0-9.]+', '-', name).lower()
+
+
+def read_distribution_metadata(path):
+    """Return (name, version) of the installed distribution which metadata
+    is located in *path* (*.dist-info, *.egg-info or *.egg), None if this is
+    not a distribution"""
+    bname = osp.basename(path)
+    match = METADATA_DIR_PATTERN.match(bname)
+    if match is None:
+        return
+    if bname.endswith('.dist-info'):
+        fname = osp.join(path, 'METADATA')
+    elif bname.endswith('.egg'):
+        fname = osp.join(path, 'EGG-INFO', 'PKG-INFO')
+    elif osp.isdir(path):
+        fname = osp.join(path, 'PKG-INFO')
+    else:
+        fname = path
+    infos = {}
+    try:
+        with io.open(fname, 'r', encoding='utf-8', errors='replace') as fd:
+            for line in fd:
+                if not line.strip():
+                    # End of headers
+                    break
+                key, _sep, value = line.partition(':')
+                if key in ('Name', 'Version'):
+                    infos[key] = value.strip()
+                    if len(infos) == 2:
+                        break
+    except (IOError, OSError):
+        pass
+    # Metadata file is missing or incomplete: fallback to directory name
+    name = infos.get('Name') or match.group(1).replace('_', '-')
+    version = infos.get('Version') or match.group(2)
+    return get_distribution_key(name), version
+
+
+def get_installed_distributions(sitedir, processes=8):
+    """Return sorted list of (key, version) of distributions installed in
+    *sitedir* (e.g. 'Lib/site-packages'), reading their metadata files
+    directly (no interpreter is started)"""
+    try:
+        names = os.listdir(sitedir)
+    except OSError:
+        return []
+    paths = [osp.join(sitedir, name) for name in names
+             if METADATA_DIR_PATTERN.match(name) is not None]
+    # (threads are not worth it for a few distributions)
+    infos = parallel_map(read_distribution_metadata, paths,
+                         processes if len(paths) > processes else 1)
+    return sorted(info for info in infos if info is not None)
+
+
+def get_distribution_metadata_paths(sitedir):
+    """Return {key: metadata path} of distributions installed in *sitedir*
+    (see read_distribution_metadata)"""
+    try:
+        names = os.listdir(sitedir)
+    except OSError:
+        return {}
+    paths = {}
+    for name in names:
+        path = osp.join(sitedir, name)
+        infos = read_distribution_metadata(path)
+        if infos is not None:
+            paths.setdefault(infos[0], path)
+    return paths
+
+
+def read_distribution_files(path):
+    """Return the list of (absolute) paths of files installed by the
+    distribution which metadata is located in *path*, reading RECORD
+    (*.dist-info) or installed-files.txt (*.egg-info), None if unknown"""
+    if path.endswith('.dist-info'):
+        fname, rootdir = osp.join(path, 'RECORD'), osp.dirname(path)
+    elif path.endswith('.egg-info') and osp.isdir(path):
+        fname, rootdir = osp.join(path, 'installed-files.txt'), path
+    else:
+        return
+    try:
+        with io.open(fname, 'r', encoding='utf-8', errors='replace') as fd:
+            lines = fd.read().splitlines()
+    except (IOError, OSError):
+        return
+    paths = [osp.join(path, osp.basename(fname))]
+    for line in lines:
+        if fname.endswith('RECORD'):
+            # CSV rows "path,hash,size" (paths with commas are quoted)
+            if line.startswith('"'):
+                relpath = line[1:line.index('"', 1)]
+            else:
+                relpath = line.split(',', 1)[0]
+        else:
+            relpath = line
+        if relpath.strip():
+            paths.append(osp.normpath(osp.join(rootdir, relpath.strip())))
+    return paths
+
+
+def get_bytecode_files(paths):
+    """Return the compiled files of the .py files among *paths* (.pyc and
+    .pyo siblings, __pycache__ entries): each __pycache__ directory is
+    listed once"""
+    pycaches = {}
+    bytecodes = []
+    for path in paths:
+        if not path.endswith('.py'):
+            continue
+        bytecodes += [path + 'c', path + 'o']
+        dirname, bname = osp.split(path)
+        pycache = osp.join(dirname, '__pycache__')
+        if pycache not in pycaches:
+            try:
+                pycaches[pycache] = os.listdir(pycache)
+            except OSError:
+                pycaches[pycache] = []
+        prefix = bname[:-2]  # 'module.'
+        bytecodes += [osp.join(pycache, name) for name in pycaches[pycache]
+                      if name.startswith(prefix)]
+    return bytecodes
+
+
+def remove_files(paths, rootdir, dirnames=(), keep=(), processes=8,
+                 verbose=False):
+    """Remove files *paths* in parallel, then directories *dirnames* and
+    the parent directories which are left empty (deepest first, up to
+    *rootdir* excluded), except directories *keep*.
+    Return the number of files removed"""
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # already removed, directory, ...
+            return 0
+        if verbose:
+            print("remove: %s" % path)
+        return 1
+    paths = sorted(set(paths))
+    count = sum(parallel_map(remove, paths, processes, chunksize=32))
+    rootdir = osp.normpath(rootdir)
+    dirnames = [osp.normpath(dirname) for dirname in dirnames]
+    parents = set()
+    for path in paths + dirnames:
+        dirname = osp.dirname(path)
+        while dirname not in parents and \
+              dirname.startswith(rootdir + os.sep):
+            parents.add(dirname)
+            dirname = osp.dirname(dirname)
+    parents.update(dirnames)
+    parents.difference_update(osp.normpath(dirname) for dirname in keep)
+    for dirname in sorted(parents, key=len, reverse=True):
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            # not empty (or already removed)
+            continue
+        if verbose:
+            print("rmdir:  %s" % dirname)
+    return count
+
+
+def list_directory(path):
+    """Return ({file name: size}, [subdirectory names]) of directory *path*
+    with os.scandir if available (sizes come with the directory listing on
+    Windows), os.listdir and os.lstat otherwise"""
+    files, subdirs = {}, []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                files[entry.name] = entry.stat(follow_symlinks=False).st_size
+    else:
+        for name in os.listdir(path):
+            st = os.lstat(osp.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+            else:
+                files[name] = st.st_size
+    return files, subdirs
+
+
+def get_tree_sizes(rootdir, cache=None):
+    """Return {relative path: size} of the files located in *rootdir*.
+    *cache* ({directory: (mtime, files, subdirs)}, updated in place) allows
+    to list again only the directories which entries have changed (file
+    sizes changed in place are not seen)"""
+    if cache is None:
+        cache = {}
+    sizes = {}
+    seen = set()
+    dirnames = ['']
+    while dirnames:
+        reldir = dirnames.pop()
+        path = osp.join(rootdir, reldir)
+        try:
+            mtime = os.stat(path).st_mtime
+            cached = cache.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = cache[path] = (mtime, ) + list_directory(path)
+        except OSError:
+            continue
+        seen.add(path)
+        _mtime, files, subdirs = cached
+        for name, size in files.items():
+            sizes[osp.join(reldir, name)] = size
+        dirnames += [osp.join(reldir, name) for name in subdirs]
+    for path in set(cache) - seen:
+        if path == rootdir or path.startswith(osp.join(rootdir, '')):
+            cache.pop(path)
+    return sizes
+
+
+def format_size(size):
+    """Return human readable *size* (bytes): '12.3 MB'"""
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'GB'
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (size, unit)
+
+
 def build_wininst(root, python_exe=None, copy_to=None,
                   architecture=None, verbose=False, installer='bdist_wininst'):
     """Build wininst installer from Python package located in *root*
@@ -598,6 +1317,34 @@ def build_wheel(this_whl, python_exe=None, copy_to=None,
             print("Installed %s" % src_fname)
         return src_fname
 
+def install_wheels(wheels, python_exe=None, verbose=False,
+                   install_options=None, chunksize=50):
+    """Install several wheels with one pip session per chunk of *chunksize*
+    wheels (keeping command lines short enough for Windows)"""
+    if python_exe is None:
+        python_exe = sys.executable
+    assert osp.isfile(python_exe)
+    myroot = os.path.dirname(python_exe)
+    for index in range(0, len(wheels), chunksize):
+        cmd = [python_exe, '-m', 'pip', 'install']
+        if install_options:
+            cmd += install_options  # typically ['--no-deps']
+        cmd += wheels[index:index+chunksize]
+        if verbose:
+            retcode = subprocess.call(cmd, cwd=myroot)
+        else:
+            p = subprocess.Popen(cmd, cwd=myroot, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+            retcode = p.returncode
+            if 'not find any' in ("%s" % stdout):
+                print("msg: %s" % stdout)
+                retcode = retcode or 1
+        if retcode != 0:
+            raise RuntimeError("Failed to install wheels (return code: %d)"
+                               % retcode)
+
+
 def do_script(this_script, python_exe=None, copy_to=None,
                 architecture=None, verbose=False, install_options=None):
     """Execute a script (get-pip typically)"""
@@ -637,6 +1384,143 @@ def wheel_to_wininst(fname, python_exe=None,
                        install_options=install_options)
 
 
+
+# =============================================================================
+# Native wheel installation (no pip subprocess)
+# =============================================================================
+# Destination of wheel '.data' subdirectories, relative to distribution root
+WHEEL_DATA_DIRS = {'purelib': osp.join('Lib', 'site-packages'),
+                   'platlib': osp.join('Lib', 'site-packages'),
+                   'scripts': 'Scripts',
+                   'headers': 'include',
+                   'data': ''}
+
+
+def get_wheel_dist_info(zfile):
+    """Return the *.dist-info directory name of wheel archive *zfile*"""
+    for name in zfile.namelist():
+        parts = name.split('/')
+        if len(parts) == 2 and parts[0].endswith('.dist-info')\
+           and parts[1] == 'WHEEL':
+            return parts[0]
+    raise RuntimeError("Invalid wheel %s: no .dist-info/WHEEL"
+                       % zfile.filename)
+
+
+def can_unpack_wheel(fname):
+    """Return True if wheel *fname* can be installed by `unpack_wheel`,
+    i.e. it requires no console/GUI scripts launchers (which are generated
+    by pip)"""
+    zfile = zipfile.ZipFile(fname)
+    try:
+        distinfo = get_wheel_dist_info(zfile)
+        wheel = zfile.read(distinfo + '/WHEEL').decode('utf-8')
+        match = re.search(r'^Wheel-Version: ([0-9]+)', wheel, re.M)
+        if match is None or int(match.group(1)) != 1:
+            return False
+        try:
+            entry_points = zfile.read(distinfo + '/entry_points.txt')
+        except KeyError:
+            return True
+        entry_points = entry_points.decode('utf-8')
+        return re.search(r'^\[(console|gui)_scripts\]', entry_points,
+                         re.M) is None
+    finally:
+        zfile.close()
+
+
+def _record_hash(digest):
+    """Return RECORD hash string of *digest* (urlsafe base64, no padding)"""
+    return 'sha256=' + base64.urlsafe_b64encode(digest).decode('ascii'
+                                                               ).rstrip('=')
+
+
+def unpack_wheel(fname, targetdir, verbose=False, installer='wppm'):
+    """Install wheel *fname* into the Python distribution *targetdir*:
+    archive members are streamed to Lib/site-packages (or to Scripts, include
+    and distribution root for '.data' subdirectories), then RECORD and
+    INSTALLER are written.
+
+    Return the list of created directories and files, relative to
+    *targetdir* (in creation order)"""
+    sitedir = WHEEL_DATA_DIRS['purelib']
+    zfile = zipfile.ZipFile(fname)
+    try:
+        distinfo = get_wheel_dist_info(zfile)
+        datadir = distinfo[:-len('.dist-info')] + '.data'
+        name = distinfo.split('-')[0]
+        installed = []
+        records = []
+
+        def makedirs(relpath):
+            """Create directory *relpath* and its missing parents"""
+            if not relpath or osp.isdir(osp.join(targetdir, relpath)):
+                return
+            makedirs(osp.dirname(relpath))
+            if verbose:
+                print("mkdir: %s" % relpath)
+            os.mkdir(osp.join(targetdir, relpath))
+            installed.append(relpath)
+
+        for info in zfile.infolist():
+            parts = info.filename.split('/')
+            if '..' in parts or info.filename.startswith('/')\
+               or ':' in parts[0]:
+                raise RuntimeError("Invalid wheel member %s" % info.filename)
+            if info.filename.endswith('/'):
+                continue
+            if parts[0] == distinfo and parts[-1] == 'RECORD':
+                continue  # written below
+            if parts[0] == datadir:
+                key = parts[1]
+                if key not in WHEEL_DATA_DIRS:
+                    raise RuntimeError("Invalid wheel data directory %s"
+                                       % key)
+                dstdir = WHEEL_DATA_DIRS[key]
+                if key == 'headers':
+                    dstdir = osp.join(dstdir, name)
+                parts = parts[2:]
+            else:
+                dstdir = sitedir
+            relpath = osp.join(dstdir, *parts)
+            makedirs(osp.dirname(relpath))
+            if verbose:
+                print("file:  %s" % relpath)
+            sha = hashlib.sha256()
+            src = zfile.open(info)
+            dst = open(osp.join(targetdir, relpath), 'wb')
+            try:
+                while True:
+                    block = src.read(1024*1024)
+                    if not block:
+                        break
+                    sha.update(block)
+                    dst.write(block)
+            finally:
+                dst.close()
+                src.close()
+            installed.append(relpath)
+            records.append((relpath, _record_hash(sha.digest()),
+                            str(info.file_size)))
+    finally:
+        zfile.close()
+
+    # INSTALLER and RECORD: paths relative to site-packages, '/' separated
+    relpath = osp.join(sitedir, distinfo, 'INSTALLER')
+    open(osp.join(targetdir, relpath), 'w').write(installer + '\n')
+    installed.append(relpath)
+    records.append((relpath, '', ''))
+    relpath = osp.join(sitedir, distinfo, 'RECORD')
+    installed.append(relpath)
+    records.append((relpath, '', ''))
+    lines = []
+    for path, digest, size in records:
+        path = osp.relpath(osp.join(targetdir, path),
+                           osp.join(targetdir, sitedir))
+        lines.append(','.join([path.replace(os.sep, '/'), digest, size]))
+    open(osp.join(targetdir, relpath), 'w').write('\n'.join(lines) + '\n')
+    return installed
+
 if __name__ == '__main__':
     gcc = get_gcc_version(osp.join(BASE_DIR, 'tools.win32', 'mingw32', 'bin'))
     print(("gcc version: %r" % gcc))
@@ -18,6 +18,9 @@ import shutil
 import re
 import sys
 import subprocess
+import sqlite3
+import hashlib
+from contextlib import contextmanager
 
 # Local imports
 from winpython import utils
@@ -25,26 +28,55 @@ from winpython.config import DATA_PATH
 from winpython.py3compat import configparser as cp
 
 # Workaround for installing PyVISA on Windows from source:
-os.environ['HOME'] = os.environ['USERPROFILE']
+if 'USERPROFILE' in os.environ:
+    os.environ['HOME'] = os.environ['USERPROFILE']
+
+
+# Package metadata databases, parsed once: {database: (mtime, index)}
+_METADATA_DB = {}
+
+
+def normalize_name(name):
+    """Return normalized package name (wheel replace '-' per '_' in names):
+    the same rule as pip keys (see utils.get_distribution_key)"""
+    return utils.get_distribution_key(name)
+
+
+def get_package_database(database):
+    """Return the local *database* indexed by normalized package name
+    ({name: {key: value}}): the ini file is parsed only once and reloaded
+    when modified"""
+    fname = osp.join(DATA_PATH, database)
+    mtime = os.stat(fname).st_mtime
+    cached = _METADATA_DB.get(database)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    db = cp.ConfigParser()
+    fd = open(fname)
+    db.readfp(fd)
+    fd.close()
+    index = {}
+    for section in db.sections():
+        index.setdefault(normalize_name(section), dict(db.items(section)))
+    _METADATA_DB[database] = (mtime, index)
+    return index
 
 
 def get_package_metadata(database, name):
     """Extract infos (description, url) from the local database"""
     # Note: we could use the PyPI database but this has been written on
     # machine which is not connected to the internet
-    db = cp.ConfigParser()
-    db.readfp(open(osp.join(DATA_PATH, database)))
+    index = get_package_database(database)
     metadata = dict(description='', url='http://pypi.python.org/pypi/' + name)
+    name1 = normalize_name(name)
+    # normalized names cover the '-'/'_' variants, then try the prefix
+    sections = [index.get(name2) for name2 in
+                (name1, normalize_name(name.split('-')[0]))]
     for key in metadata:
-        name1 = name.lower()
-        # wheel replace '-' per '_' in key
-        for name2 in (name1, name1.split('-')[0], name1.replace('-', '_'),
-                      '-'.join(name1.split('_'))):
-            try:
-                metadata[key] = db.get(name2, key)
+        for section in sections:
+            if section is not None and key in section:
+                metadata[key] = section[key]
                 break
-            except (cp.NoSectionError, cp.NoOptionError):
-                pass
     return metadata
 
 
@@ -55,8 +87,21 @@ class BasePackage(object):
         self.version = None
         self.architecture = None
         self.pyversion = None
-        self.description = None
-        self.url = None
+        self._metadata = None  # optional infos, extracted on demand
+
+    @property
+    def description(self):
+        """Return package description (from the package database)"""
+        if self._metadata is None:
+            self.extract_optional_infos()
+        return self._metadata['description']
+
+    @property
+    def url(self):
+        """Return package website (from the package database)"""
+        if self._metadata is None:
+            self.extract_optional_infos()
+        return self._metadata['url']
 
     def __str__(self):
         text = "%s %s" % (self.name, self.version)
@@ -87,9 +132,7 @@ class BasePackage(object):
     def extract_optional_infos(self):
         """Extract package optional infos (description, url)
         from the package database"""
-        metadata = get_package_metadata('packages.ini', self.name)
-        for key, value in list(metadata.items()):
-            setattr(self, key, value)
+        self._metadata = get_package_metadata('packages.ini', self.name)
 
 
 class Package(BasePackage):
@@ -97,57 +140,16 @@ class Package(BasePackage):
         BasePackage.__init__(self, fname)
         self.files = []
         self.extract_infos()
-        self.extract_optional_infos()
 
     def extract_infos(self):
         """Extract package infos (name, version, architecture)
         from filename (installer basename)"""
-        bname = osp.basename(self.fname)
-        if bname.endswith('.exe'):
-            # distutils bdist_wininst
-            match = re.match(utils.WININST_PATTERN, bname)
-            if match is not None:
-                (self.name, self.version,
-                 _t0, _qtver, arch, _t1, self.pyversion, _t2) = match.groups()
-                self.architecture = 32 if arch == 'win32' else 64
-                return
-            # NSIS
-            pat = r'([a-zA-Z0-9\-\_]*)-Py([0-9\.]*)-x(64|32)-gpl-([0-9\.\-]*[a-z]*)\.exe'
-            match = re.match(pat, bname)
-            if match is not None:
-                self.name, self.pyversion, arch, self.version = match.groups()
-                self.architecture = int(arch)
-                return
-            # NSIS complement to match PyQt4-4.10.4-gpl-Py3.4-Qt4.8.6-x32.exe
-            pat = r'([a-zA-Z0-9\_]*)-([0-9\.]*[a-z]*)-gpl-Py([0-9\.]*)-.*-x(64|32)\.exe'
-            match = re.match(pat, bname)
-            if match is not None:
-                self.name, self.version, self.pyversion, arch = match.groups()
-                self.architecture = int(arch)
-                return
-            match = re.match(r'([a-zA-Z0-9\-\_]*)-([0-9\.]*[a-z]*)-py([0-9\.]*)-x(64|32)-([a-z0-9\.\-]*).exe', bname)
-            if match is not None:
-                self.name, self.version, self.pyversion, arch, _pyqt = match.groups()
-                self.architecture = int(arch)
-                return
-        # New : Binary wheel case
-        elif bname.endswith(('32.whl', '64.whl')):
-            match = re.match(utils.WHEELBIN_PATTERN, bname)
-            # typical macht is ('scipy', '0.14.1rc1', '34', 'win32')
-            if match is not None:
-                self.name, self.version,  self.pywheel , arch  = match.groups()
-                # self.pywheel version is '34' not 3.4
-                self.pyversion = self.pywheel[:1] + '.' + self.pywheel[1:]
-                # wheel arch is 'win32' or 'win_amd64'
-                self.architecture = 32 if arch == 'win32' else 64
-                return
-        elif bname.endswith(('.zip', '.tar.gz', '.whl')):
-            # distutils sdist
-            infos = utils.get_source_package_infos(bname)
-            if infos is not None:
-                self.name, self.version = infos
-                return
-        raise NotImplementedError("Not supported package type %s" % bname)
+        infos = utils.get_package_infos(self.fname)
+        if infos is None:
+            raise NotImplementedError("Not supported package type %s"
+                                      % osp.basename(self.fname))
+        (self.name, self.version, self.pyversion, self.architecture,
+         _kind) = infos
 
     def logpath(self, logdir):
         """Return full log path"""
@@ -190,7 +192,6 @@ class WininstPackage(BasePackage):
         self.architecture = distribution.architecture
         self.pyversion = distribution.version
         self.extract_infos()
-        self.extract_optional_infos()
 
     def extract_infos(self):
         """Extract package infos (name, version, architecture)"""
@@ -221,6 +222,146 @@ class WininstPackage(BasePackage):
                         cwd=self.distribution.target)
 
 
+@contextmanager
+def closing_connection(connection):
+    """Commit (or rollback on error) and close sqlite *connection*"""
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class InstallManifest(object):
+    """Files installed by WPPM, stored in a sqlite database per distribution
+    (package -> files, sizes and hashes; file -> owner package).
+    Packages are identified by their installer basename (see Package.fname),
+    files by their path relative to the distribution root directory"""
+    FNAME = 'wppm.sqlite'
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    fname TEXT PRIMARY KEY,
+    name TEXT,
+    version TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT,
+    package TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    PRIMARY KEY (path, package));
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        with self.connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+    def connect(self):
+        """Return a new connection: a connection is used only in the thread
+        which has created it (control panel installs in a QThread)"""
+        return closing_connection(sqlite3.connect(self.fname))
+
+    def get_packages(self):
+        """Return installer basenames of packages"""
+        with self.connect() as connection:
+            return [row[0] for row in
+                    connection.execute("SELECT fname FROM packages")]
+
+    def get_names(self):
+        """Return {installer basename: project name} of packages"""
+        with self.connect() as connection:
+            return dict(connection.execute("SELECT fname, name FROM packages"))
+
+    def get_files(self, fname):
+        """Return files of package *fname* (in installation order), None
+        if package is unknown"""
+        sizes = self.get_file_sizes(fname)
+        if sizes is not None:
+            return [path for path, _size in sizes]
+
+    def get_file_sizes(self, fname):
+        """Return [(path, size)] of package *fname* files (in installation
+        order, size is None for directories), None if package is unknown"""
+        fname = osp.basename(fname)
+        with self.connect() as connection:
+            if connection.execute("SELECT 1 FROM packages WHERE fname=?",
+                                  (fname, )).fetchone() is None:
+                return
+            return connection.execute(
+                "SELECT path, size FROM files WHERE package=? ORDER BY rowid",
+                (fname, )).fetchall()
+
+    def find_owner(self, path):
+        """Return installer basename of the package owning file *path*
+        (relative to the distribution root directory), None if not found"""
+        with self.connect() as connection:
+            row = connection.execute("SELECT package FROM files WHERE path=?",
+                                     (osp.normpath(path), )).fetchone()
+        if row is not None:
+            return row[0]
+
+    def add_package(self, package, rootdir, files=None):
+        """Add (or replace) *package* with its *files* (default:
+        package.files) installed in *rootdir*"""
+        fname = osp.basename(package.fname)
+        rows, known = [], set()
+        for path in package.files if files is None else files:
+            path = osp.normpath(path)
+            if path in known:
+                continue
+            known.add(path)
+            size, sha256 = None, None
+            full_path = osp.join(rootdir, path)
+            if osp.isfile(full_path):
+                size = osp.getsize(full_path)
+                sha256 = hashlib.sha256()
+                with open(full_path, 'rb') as fd:
+                    for block in iter(lambda: fd.read(1 << 20), b''):
+                        sha256.update(block)
+                sha256 = sha256.hexdigest()
+            rows.append((path, fname, size, sha256))
+        with self.connect() as connection:
+            self._remove_package(connection, fname)
+            connection.execute("INSERT INTO packages VALUES (?, ?, ?)",
+                               (fname, package.name, package.version))
+            connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                   rows)
+
+    def _remove_package(self, connection, fname):
+        connection.execute("DELETE FROM files WHERE package=?", (fname, ))
+        connection.execute("DELETE FROM packages WHERE fname=?", (fname, ))
+
+    def get_owners(self):
+        """Return [(path, package name)] of all files"""
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT files.path, packages.name FROM files "
+                "JOIN packages ON files.package = packages.fname").fetchall()
+
+    def remove_package(self, fname):
+        """Remove package *fname*"""
+        with self.connect() as connection:
+            self._remove_package(connection, osp.basename(fname))
+
+    def import_logs(self, logdir, rootdir):
+        """Import WPPM package logs (*.log files, see Package.save_log) of
+        packages which are not already in manifest: return their number"""
+        packages = set(self.get_packages())
+        count = 0
+        for logname in os.listdir(logdir):
+            if not logname.endswith('.log') or logname[:-4] in packages:
+                continue
+            try:
+                package = Package(logname[:-4])
+            except NotImplementedError:
+                continue
+            package.load_log(logdir)
+            self.add_package(package, rootdir)
+            count += 1
+        return count
+
+
 class Distribution(object):
     # PyQt module is now like :PyQt4-...
     NSIS_PACKAGES = ('PyQt4', 'PyQwt')  # known NSIS packages
@@ -230,12 +371,26 @@ class Distribution(object):
         self.verbose = verbose
         self.indent = indent
         self.logdir = None
+        self.manifest = None
         self.init_log_dir()
         self.to_be_removed = []  # list of directories to be removed later
         self.version, self.architecture = utils.get_python_infos(target)
+        # installed packages cache: (stamp, packages, {normalized name: pack})
+        self._installed = None
+        # file owners cache: (stamp, {normcased relative path: name})
+        self._owners = None
+        self._tree_cache = {}  # see utils.get_tree_sizes
+        # if True, Scripts launchers are not patched after each installation
+        # (patch_scripts is called once, e.g. at the end of a build)
+        self.defer_patch_scripts = False
 
     def clean_up(self):
-        """Remove directories which couldn't be removed when building"""
+        """Remove directories which couldn't be removed when building, and
+        the Python probe cache (see utils.get_python_probe: not to be
+        shipped with the distribution)"""
+        probe_cache = osp.join(self.target, utils.PYTHON_PROBE_CACHE)
+        if osp.isfile(probe_cache):
+            os.remove(probe_cache)
         for path in self.to_be_removed:
             try:
                 shutil.rmtree(path, onerror=utils.onerror)
@@ -256,6 +411,9 @@ class Distribution(object):
         if not osp.exists(path):
             os.mkdir(path)
         self.logdir = path
+        self.manifest = InstallManifest(osp.join(path, InstallManifest.FNAME))
+        # Logs written by previous WPPM versions
+        self.manifest.import_logs(path, self.target)
 
     def copy_files(self, package, targetdir,
                    srcdir, dstdir, create_bat_files=False):
@@ -309,11 +467,43 @@ python "%~dpn0""" + ext + """" %*""")
         open(full_dst, 'w').write(contents)
         package.files.append(dst)
 
+    def _get_installed_stamp(self):
+        """Return modification times of the directories defining which
+        packages are installed (logs, wininst uninstallers, site-packages)"""
+        stamp = []
+        for path in (self.manifest.fname, self.target,
+                     osp.join(self.target, 'Lib', 'site-packages')):
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _get_installed_index(self):
+        """Return (stamp, packages, index) of installed packages, rescanning
+        the distribution only if it has changed since the last call"""
+        stamp = self._get_installed_stamp()
+        if self._installed is None or self._installed[0] != stamp:
+            packages = self._scan_installed_packages()
+            index = {}
+            for pack in packages:
+                index.setdefault(normalize_name(pack.name), pack)
+            self._installed = (stamp, packages, index)
+        return self._installed
+
+    def invalidate_installed_packages(self):
+        """Force a rescan of installed packages on next query"""
+        self._installed = None
+
     def get_installed_packages(self):
         """Return installed packages"""
+        return list(self._get_installed_index()[1])
+
+    def _scan_installed_packages(self):
+        """Scan distribution for installed packages"""
         # Packages installed with WPPM
-        wppm = [Package(logname[:-4]) for logname in os.listdir(self.logdir)
-                if '.whl.log' not in logname ]
+        wppm = [Package(fname) for fname in self.manifest.get_packages()
+                if not fname.endswith('.whl')]
         # Packages installed with distutils wininst
         wininst = []
         for name in os.listdir(self.target):
@@ -324,41 +514,108 @@ python "%~dpn0""" + ext + """" %*""")
                     continue
                 if pack.name is not None and pack.version is not None:
                     wininst.append(pack)
-        # Include package installed via pip (not via WPPM)
-        try:
-            if os.path.dirname(sys.executable) == self.target:
-                #  direct way: we interrogate ourself
-                import imp, pip
-                pip.utils.pkg_resources = imp.reload(pip.utils.pkg_resources)
-                pip_list = [(i.key, i.version)
-                             for i in pip.get_installed_distributions()]
-            else:
-                #  indirect way: we interrogate something else
-                cmdx=[osp.join(self.target, 'python.exe'), '-c',
-                      "import pip;print('+!+'.join(['%s@+@%s@+@' % (i.key,i.version)  for i in pip.get_installed_distributions()]))"]
-                p = subprocess.Popen(cmdx, shell=True, stdout=subprocess.PIPE,
-                                     cwd=self.target)
-                stdout, stderr = p.communicate()
-                start_at = 2 if sys.version_info >= (3,0) else 0
-                pip_list = [line.split("@+@")[:2] for line in
-                            ("%s" % stdout)[start_at:].split("+!+")]
-
-            # create pip package list
-            wppip = [Package('%s-%s-py2.py3-none-any.whl' %
-                     (i[0].lower(), i[1])) for i in pip_list]
-            # pip package version is supposed better
-            already = set(b.name.replace('-', '_') for b in wppip+wininst)
-            wppm = wppip + [i for i in wppm
-                            if i.name.replace('-', '_').lower() not in already]
-        except:
-            pass
+        # Include package installed via pip (not via WPPM), reading their
+        # metadata in site-packages
+        wppip = []
+        sitedir = osp.join(self.target, 'Lib', 'site-packages')
+        for key, version in utils.get_installed_distributions(sitedir):
+            try:
+                wppip.append(Package('%s-%s-py2.py3-none-any.whl'
+                                     % (key, version)))
+            except NotImplementedError:
+                if self.verbose:
+                    print("unsupported version: %s %s" % (key, version),
+                          file=sys.stderr)
+        # pip package version is supposed better
+        already = set(normalize_name(b.name) for b in wppip+wininst)
+        wppm = wppip + [i for i in wppm
+                        if normalize_name(i.name) not in already]
         return sorted(wppm + wininst, key=lambda tup: tup.name.lower())
 
+    def get_manifest_fname(self, package):
+        """Return the install manifest key of package: its installer
+        basename, or the one of the package with the same normalized name
+        (packages installed from a wheel are found by scanning their
+        metadata, e.g. 'foo-bar-1.0-py2.py3-none-any.whl' for
+        'Foo_Bar-1.0-py3-none-any.whl')"""
+        fname = osp.basename(package.fname)
+        names = self.manifest.get_names()
+        if fname not in names:
+            name = normalize_name(package.name)
+            for other, other_name in names.items():
+                if normalize_name(other_name) == name:
+                    return other
+        return fname
+
+    def load_package_files(self, package):
+        """Load the list of files installed with package (package.files)"""
+        fname = self.get_manifest_fname(package)
+        package.files = self.manifest.get_files(fname) or []
+
+    def forget_package(self, package):
+        """Remove package from install manifest (and its legacy log)"""
+        fname = self.get_manifest_fname(package)
+        self.manifest.remove_package(fname)
+        logpath = osp.join(self.logdir, fname + '.log')
+        if osp.isfile(logpath):
+            os.remove(logpath)
+
+    def get_file_owners(self):
+        """Return {normcased path (relative to target): normalized package
+        name} of files listed by install manifest and distribution metadata
+        (RECORD, installed-files.txt), rebuilt only if packages changed"""
+        stamp = self._get_installed_stamp()
+        if self._owners is None or self._owners[0] != stamp:
+            owners = {}
+            for path, name in self.manifest.get_owners():
+                owners[osp.normcase(path)] = normalize_name(name)
+            sitedir = osp.join(self.target, 'Lib', 'site-packages')
+            metadata = utils.get_distribution_metadata_paths(sitedir)
+            for key, path in metadata.items():
+                name = normalize_name(key)
+                for fname in utils.read_distribution_files(path) or []:
+                    relpath = osp.relpath(fname, self.target)
+                    owners[osp.normcase(relpath)] = name
+            self._owners = (stamp, owners)
+        return self._owners[1]
+
+    def find_file_owner(self, path):
+        """Return normalized name of the package owning file *path*
+        (absolute or relative to target), None if not found"""
+        if osp.isabs(path):
+            path = osp.relpath(path, self.target)
+        return self.get_file_owners().get(osp.normcase(osp.normpath(path)))
+
+    def get_package_sizes(self):
+        """Return ({normalized package name: size in bytes}, size of files
+        not owned by any package): distribution files are scanned again
+        only in directories which have changed since the last call.
+        Compiled files (.pyc, .pyo, __pycache__) belong to the package
+        owning their .py source file"""
+        owners = self.get_file_owners()
+        sizes, other = {}, 0
+        for path, size in utils.get_tree_sizes(self.target,
+                                               self._tree_cache).items():
+            path = osp.normcase(path)
+            name = owners.get(path)
+            if name is None and path.endswith(('.pyc', '.pyo')):
+                dirname, bname = osp.split(path)
+                if osp.basename(dirname) == '__pycache__':
+                    # __pycache__/module.cpython-34.pyc
+                    source = osp.join(osp.dirname(dirname),
+                                      bname.split('.')[0] + '.py')
+                else:
+                    source = path[:-1]
+                name = owners.get(source)
+            if name is None:
+                other += size
+            else:
+                sizes[name] = sizes.get(name, 0) + size
+        return sizes, other
+
     def find_package(self, name):
         """Find installed package"""
-        for pack in self.get_installed_packages():
-            if pack.name == name:
-                return pack
+        return self._get_installed_index()[2].get(normalize_name(name))
 
     def uninstall_existing(self, package):
         """Uninstall existing package"""
@@ -370,6 +627,7 @@ python "%~dpn0""" + ext + """" %*""")
         """Install package in distribution"""
         assert package.is_compatible_with(self)
         tmp_fname = None
+        scripts_stamp = self.get_scripts_stamp()
         # (tragic if pip) self.uninstall_existing(package)
         if package.fname.endswith(('.tar.gz', '.zip')):
             self._print(package, "Building")
@@ -397,10 +655,44 @@ python "%~dpn0""" + ext + """" %*""")
         elif bname.endswith('.msi'):
             self.install_bdist_msi(package)
         self.handle_specific_packages(package)
-        package.save_log(self.logdir)
+        self.manifest.add_package(package, self.target)
+        self.invalidate_installed_packages()
         if tmp_fname is not None:
             os.remove(tmp_fname)
 
+        self._post_install(package, scripts_stamp)
+
+    def install_wheels(self, packages, install_options=None):
+        """Install wheel packages in distribution with a single pip session"""
+        for package in packages:
+            assert package.is_compatible_with(self)
+            assert package.fname.endswith('.whl')
+        text = "Installing %d wheels" % len(packages)
+        scripts_stamp = self.get_scripts_stamp()
+        if self.verbose:
+            utils.print_box(text)
+        else:
+            print(((' '*4) if self.indent else '') + text + '...', end=" ")
+        try:
+            utils.install_wheels([package.fname for package in packages],
+                          python_exe=osp.join(self.target, 'python.exe'),
+                          verbose=self.verbose, install_options=install_options)
+        except RuntimeError:
+            if not self.verbose:
+                print("Failed!")
+            raise
+        self._print_done()
+        for package in packages:
+            self.handle_specific_packages(package)
+            self.manifest.add_package(package, self.target)
+            self._post_install(package)
+        if not self.defer_patch_scripts:
+            self.patch_scripts(self.get_changed_scripts(scripts_stamp))
+        self.invalidate_installed_packages()
+
+    def _post_install(self, package, scripts_stamp=None):
+        """Post-install actions for specific packages: Scripts launchers
+        changed since *scripts_stamp* (see get_scripts_stamp) are patched"""
         # We minimal post-install pywin (pywin32_postinstall.py do too much)
         if package.name == "pywin32":
             origin = self.target + (r"\Lib\site-packages\pywin32_system32")
@@ -417,21 +709,9 @@ python "%~dpn0""" + ext + """" %*""")
             self.install_script(my_script_is, install_options=None)
         # change of method 2014-05-08:
         # touching pip at installation seems not working anymore
-        # so brute force method is applied
-        if package.name == "pip" or package.name == "get-pip" or 1 == 1:
-            import glob
-            for ffname in glob.glob(r'%s\Scripts\*.exe' % self.target):
-                utils.patch_shebang_line(ffname)
-            # ensure pip.exe and easy_install.exe
-            problems = [('pip', 'pip'), ('easy_install', 'easy_install-')]
-            solutions = [('%s.%s' % sys.version_info[:2]),
-                         ('%s' % sys.version_info[0])]
-            for p in problems:
-                problem = r'%s\Scripts\%s.exe' % (self.target, p[0])
-                for s in solutions:
-                    solution = r'%s\Scripts\%s%s.exe' % (self.target, p[1], s)
-                    if not osp.exists(problem) and osp.exists(solution):
-                        shutil.copyfile(solution, problem)
+        # so every launcher created or replaced by installation is patched
+        if scripts_stamp is not None and not self.defer_patch_scripts:
+            self.patch_scripts(self.get_changed_scripts(scripts_stamp))
 
         if package.name == "pip" or package.name == "get-pip":
             utils.patch_sourcefile(
@@ -447,6 +727,42 @@ python "%~dpn0""" + ext + """" %*""")
               r" kernel_dict = json.loads(('\n'.join(f.readlines())).replace('[WINPYDIR]',(os.environ['WINPYDIR']).replace('\\','\\\\')))"+
               ";" + "from  winpython.utils import patch_julia03; patch_julia03()")
 
+    def get_scripts_stamp(self):
+        """Return {launcher path: (size, mtime)} of Scripts\\*.exe"""
+        import glob
+        stamp = {}
+        for fname in glob.glob(r'%s\Scripts\*.exe' % self.target):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            stamp[fname] = (st.st_size, st.st_mtime)
+        return stamp
+
+    def get_changed_scripts(self, stamp):
+        """Return Scripts launchers created or modified since *stamp* was
+        taken (see get_scripts_stamp)"""
+        return [fname for fname, value in self.get_scripts_stamp().items()
+                if stamp.get(fname) != value]
+
+    def patch_scripts(self, fnames=None):
+        """Make Scripts launchers *fnames* (default: all Scripts\\*.exe)
+        relocatable (relative shebang lines, patched in parallel) and
+        ensure pip.exe and easy_install.exe"""
+        if fnames is None:
+            fnames = self.get_scripts_stamp()
+        utils.patch_shebang_lines(fnames)
+        # ensure pip.exe and easy_install.exe
+        problems = [('pip', 'pip'), ('easy_install', 'easy_install-')]
+        solutions = [('%s.%s' % sys.version_info[:2]),
+                     ('%s' % sys.version_info[0])]
+        for p in problems:
+            problem = r'%s\Scripts\%s.exe' % (self.target, p[0])
+            for s in solutions:
+                solution = r'%s\Scripts\%s%s.exe' % (self.target, p[1], s)
+                if not osp.exists(problem) and osp.exists(solution):
+                    shutil.copyfile(solution, problem)
+
     def handle_specific_packages(self, package):
         """Packages requiring additional configuration"""
         if package.name in ('PyQt', 'PyQt4'):
@@ -490,7 +806,7 @@ python "%WINPYDIR%\Lib\site-packages\PyQt4\uic\pyuic.py" %1 %2 %3 %4 %5 %6 %7 %8
         self._print(package, "Uninstalling")
         if isinstance(package, WininstPackage):
             package.uninstall()
-            package.remove_log(self.logdir)
+            self.forget_package(package)
         elif not package.name == 'pip':
             # trick to get true target (if not current)
             this_executable_path = os.path.dirname(self.logdir)
@@ -498,7 +814,7 @@ python "%WINPYDIR%\Lib\site-packages\PyQt4\uic\pyuic.py" %1 %2 %3 %4 %5 %6 %7 %8
                             '-m', 'pip', 'uninstall', package.name, '-y'],
                             cwd=this_executable_path)
             # legacy, if some package installed by old non-pip means
-            package.load_log(self.logdir)
+            self.load_package_files(package)
             for fname in reversed(package.files):
                 path = osp.join(self.target, fname)
                 if osp.isfile(path):
@@ -532,7 +848,67 @@ python "%WINPYDIR%\Lib\site-packages\PyQt4\uic\pyuic.py" %1 %2 %3 %4 %5 %6 %7 %8
                 else:
                     if self.verbose:
                         print("file not found: %s" % fname, file=sys.stderr)
-            package.remove_log(self.logdir)
+            self.forget_package(package)
+        self.invalidate_installed_packages()
+        self._print_done()
+
+    def uninstall_many(self, packages):
+        """Uninstall packages from distribution at once: their files are
+        read from distribution metadata (RECORD, installed-files.txt) and
+        WPPM logs, then removed in parallel; pip is started once, for the
+        packages without such file lists"""
+        text = "Uninstalling %d packages" % len(packages)
+        if self.verbose:
+            utils.print_box(text)
+        else:
+            print(((' '*4) if self.indent else '') + text + '...', end=" ")
+        sitedir = osp.join(self.target, 'Lib', 'site-packages')
+        metadata = utils.get_distribution_metadata_paths(sitedir)
+        paths, dirnames, pip_names = [], [], []
+        for package in packages:
+            if isinstance(package, WininstPackage):
+                package.uninstall()
+                self.forget_package(package)
+                continue
+            elif package.name == 'pip':
+                continue
+            key = normalize_name(package.name)
+            files = None
+            if key in metadata:
+                files = utils.read_distribution_files(metadata[key])
+                if files is None:
+                    pip_names.append(package.name)
+                    files = []
+                elif self.verbose:
+                    print("%s: %d file(s) listed in %s"
+                          % (package.name, len(files), metadata[key]))
+            # legacy, if some package installed by old non-pip means
+            sizes = self.manifest.get_file_sizes(
+                self.get_manifest_fname(package)) or []
+            if files is None and not sizes:
+                pip_names.append(package.name)
+                continue
+            for fname, size in sizes:
+                path = osp.join(self.target, fname)
+                if size is None:
+                    dirnames.append(path)
+                else:
+                    paths.append(path)
+            paths += files or []
+            self.forget_package(package)
+        paths += utils.get_bytecode_files(paths)
+        # distribution directories (Scripts, Lib, ...) are kept, even empty
+        keep = [osp.join(self.target, name)
+                for name in os.listdir(self.target)]
+        utils.remove_files(paths, self.target, dirnames=dirnames,
+                           keep=keep + [sitedir], verbose=self.verbose)
+        if pip_names:
+            # trick to get true target (if not current)
+            this_executable_path = os.path.dirname(self.logdir)
+            subprocess.call([this_executable_path + r'\python.exe',
+                            '-m', 'pip', 'uninstall', '-y'] + pip_names,
+                            cwd=this_executable_path)
+        self.invalidate_installed_packages()
         self._print_done()
 
     def install_bdist_wininst(self, package):
@@ -555,6 +931,12 @@ python "%WINPYDIR%\Lib\site-packages\PyQt4\uic\pyuic.py" %1 %2 %3 %4 %5 %6 %7 %8
 
     def install_bdist_wheel(self, package, install_options=None):
         """Install a wheel directly !"""
+        # Without pip, wheel dependencies are not installed: the wheel is
+        # unpacked only if this is explicitly asked for ('--no-deps')
+        if install_options and '--no-deps' in install_options \
+           and utils.can_unpack_wheel(package.fname):
+            self.unpack_bdist_wheel(package)
+            return
         self._print(package, "Installing Wheel")
         # targetdir = utils.extract_msi(package.fname, targetdir=self.target)
         try:
@@ -569,6 +951,21 @@ python "%WINPYDIR%\Lib\site-packages\PyQt4\uic\pyuic.py" %1 %2 %3 %4 %5 %6 %7 %8
         package = Package(fname)
         self._print_done()
 
+    def unpack_bdist_wheel(self, package):
+        """Install a wheel without starting pip: files are extracted to the
+        distribution and listed in package log (exact uninstall)"""
+        self.uninstall_existing(package)
+        self._print(package, "Unpacking Wheel")
+        package.files = utils.unpack_wheel(package.fname, self.target,
+                                           verbose=self.verbose)
+        for fname in list(package.files):
+            name, ext = osp.splitext(fname)
+            if osp.dirname(fname) == 'Scripts' and ext in ('', '.py'):
+                self.create_file(package, osp.basename(name) + '.bat',
+                                 'Scripts', """@echo off
+python "%~dpn0""" + ext + """" %*""")
+        self._print_done()
+
     def install_script(self, script, install_options=None):
         try:
             fname = utils.do_script(script,